@@ -11,7 +11,7 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
-name, version = 'zc.zkzeo', '1.0.1'
+name, version = 'zc.zkzeo', '1.1.0.dev0'
 
 install_requires = [
     'setuptools', 'zc.zk', 'ZEO', 'zc.thread']
@@ -20,12 +20,15 @@ extras_require = dict(
           'zope.configuration'],
     static=[],
     monitor=['zc.monitor', 'zope.configuration'],
+    benchmark=['zope.testing', 'zc.zk [test]'],
     )
 
 entry_points = """
 [console_scripts]
 zkrunzeo = zc.zkzeo.runzeo:main
 zkzeo-nagios = zc.zkzeo.nagios:main
+zkzeo-exporter = zc.zkzeo.exporter:main
+zkzeo-benchmark = zc.zkzeo.benchmark:main
 """
 
 from setuptools import setup
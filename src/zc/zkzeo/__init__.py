@@ -17,8 +17,23 @@ def client(zookeeper_connection_string, path, *args, **kw):
     return zc.zkzeo._client.client(zookeeper_connection_string, path,
                                    *args, **kw)
 
+def open_client(zookeeper_connection_string, path, callback, *args, **kw):
+    import zc.zkzeo._client
+    return zc.zkzeo._client.open_client(zookeeper_connection_string, path,
+                                        callback, *args, **kw)
+
+def snapshot_cache(storage, path):
+    import zc.zkzeo._client
+    return zc.zkzeo._client.snapshot_cache(storage, path)
+
 def DB(zookeeper_connection_string, path, *args, **kw):
     import ZODB
+    if kw.pop('lazy', False):
+        import zc.zkzeo._client
+        return zc.zkzeo._client.LazyDB(
+            zookeeper_connection_string, path,
+            lambda : ZODB.DB(
+                client(zookeeper_connection_string, path, *args, **kw)))
     return ZODB.DB(client(zookeeper_connection_string, path, *args, **kw))
 
 def connection(zookeeper_connection_string, path, *args, **kw):
@@ -26,3 +41,20 @@ def connection(zookeeper_connection_string, path, *args, **kw):
     conn = db.open()
     conn.onCloseCallback(db.close)
     return conn
+
+def databases(zookeeper_connection_string, path, *args, **kw):
+    import zc.zkzeo._client
+    factory = kw.pop('factory', DB)
+    return zc.zkzeo._client.Databases(zookeeper_connection_string, path,
+                                      factory, args, kw)
+
+def databaseFromString(text, threads=4):
+    import cStringIO
+    return databaseFromFile(cStringIO.StringIO(text), threads)
+
+def databaseFromFile(f, threads=4):
+    import ZConfig
+    import ZODB.config
+    import zc.zkzeo._client
+    config, handler = ZConfig.loadConfigFile(ZODB.config.getDbSchema(), f)
+    return zc.zkzeo._client.databaseFromConfig(config.database, threads)
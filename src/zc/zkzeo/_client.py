@@ -11,45 +11,496 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+import binascii
+import hashlib
+import json
 import logging
+import math
+import os
+import random
+import shutil
+import socket
 import time
+import zc.thread
 import zc.zk
+import zc.zkzeo.status
 import ZEO.ClientStorage
+import ZEO.cache
+import ZODB.ActivityMonitor
+import ZODB.TimeStamp
 import threading
+import zookeeper
 
 logger = logging.getLogger('zc.zkzeo')
 
+# Clients of the same ZooKeeper ensemble share a session, and clients
+# of the same path share a children watch.  _sessions_lock only guards
+# the _sessions mapping and session users.  Connecting and watching are
+# done holding just the session's lock, so a slow or unreachable
+# ensemble doesn't hold up clients of others.
+_sessions = {} # {zkaddr -> _Session}
+_sessions_lock = threading.Lock()
+
+class _Session:
+
+    def __init__(self, zkaddr):
+        self.zkaddr = zkaddr
+        self.zk = None # Connected by the first user
+        self.lock = threading.Lock()
+        self.users = 0 # Calls to _acquire not matched by _release yet
+        self.children = {} # {path -> zc.zk.Children}
+        self.refs = {} # {path -> number of clients using the path}
+
+def _acquire(zkaddr, path):
+    """Get the (shared) children of path, opening a session if necessary.
+
+    Every call must be matched by a call to _release.
+    """
+    with _sessions_lock:
+        session = _sessions.get(zkaddr)
+        if session is None:
+            session = _sessions[zkaddr] = _Session(zkaddr)
+        session.users += 1
+    try:
+        with session.lock:
+            if session.zk is None:
+                session.zk = zc.zk.ZooKeeper(zkaddr)
+            addresses = session.children.get(path)
+            if addresses is None:
+                addresses = session.children[path] = session.zk.children(
+                    path)
+            session.refs[path] = session.refs.get(path, 0) + 1
+            return addresses
+    except:
+        _discard(session)
+        raise
+
+def _release(zkaddr, path, callback=None):
+    with _sessions_lock:
+        session = _sessions[zkaddr]
+    with session.lock:
+        addresses = session.children[path]
+        if callback in addresses.callbacks:
+            addresses.callbacks.remove(callback)
+        session.refs[path] -= 1
+        if not session.refs[path]:
+            del session.refs[path]
+            del session.children[path]
+    _discard(session)
+
+def _discard(session):
+    # A user is done with a session.  Close it if it was the last.
+    with _sessions_lock:
+        session.users -= 1
+        if session.users:
+            return
+        del _sessions[session.zkaddr]
+    with session.lock:
+        if session.zk is not None:
+            session.zk.close()
+
+# Client options handled by zc.zkzeo rather than ClientStorage,
+# with their defaults.
+_options = dict(
+    selection=None,
+    probe_interval=60,
+    client_id=None,
+    max_lag=None,
+    debounce=0,
+    failover_jitter=0,
+    max_reconnects=None,
+    on_change=None,
+    address_cache=None,
+    cache_snapshot=None,
+    standby=None,
+    zone=None,
+    unix_sockets=False,
+    resolve_ttl=None,
+    )
+
+# Clients in this process reconnecting after failover, for max_reconnects.
+_reconnecting = [0]
+_reconnecting_condition = threading.Condition()
+
+# How long a reconnecting client can hold up others, in seconds.
+_reconnect_timeout = 60
+
+# How long to hold up new transactions while moving away from an
+# unregistered server, in seconds.
+_migrate_timeout = 10
+
+# How long to try to connect to a selection's preferred address before
+# trying the others, in seconds.
+_fallback_delay = 10
+
 def client(zkaddr, path, *args, **kw):
-    zk = zc.zk.ZooKeeper(zkaddr)
-    addresses = zk.children(path)
-    wait = kw.get('wait', kw.get('wait_for_server_on_startup', True))
-    client = ZEO.ClientStorage.ClientStorage(
-        _wait_addresses(addresses, parse_addr, zkaddr, path, wait),
-        *args, **kw)
-    return _client(addresses, client, zkaddr, path)
+    options = _pop_options(kw)
+    stats = Stats()
+    _prewarm(options['cache_snapshot'], kw.get('client'), kw.get('var'),
+             kw.get('storage', '1'), stats)
+    cached = _cached_addresses(options['address_cache'], zkaddr, path)
+    if cached:
+        # Don't wait for ZooKeeper. Start with the addresses we had
+        # last time.  They may be stale, so if we're asked to wait,
+        # we wait after ZooKeeper can give us new ones.
+        stats.waited(0.0)
+        wait = kw.pop('wait', kw.pop('wait_for_server_on_startup', True))
+        client = ZEO.ClientStorage.ClientStorage(
+            map(parse_addr, cached), *args, wait=False, **kw)
+        client = _reconcile(client, zkaddr, path, options, stats)
+        if wait:
+            _wait_connected(client, kw.get('wait_timeout'))
+        return client
+
+    addresses = _acquire(zkaddr, path)
+    try:
+        selection = _selection(options, addresses)
+        wait = kw.get('wait', kw.get('wait_for_server_on_startup', True))
+        start = time.time()
+        addrs = _wait_addresses(
+            addresses, _address_transform(addresses, options, stats),
+            zkaddr, path, wait, kw.get('wait_timeout'), selection)
+        stats.waited(time.time() - start)
+        if wait and not addrs:
+            # We timed out waiting for addresses, so don't wait to connect.
+            wait = False
+            kw.pop('wait_for_server_on_startup', None)
+            kw['wait'] = False
+        first = _first_choice(addrs, selection)
+        if wait and first != addrs:
+            # Wait once we can fall back to the other addresses.
+            kw.pop('wait_for_server_on_startup', None)
+            kw['wait'] = False
+        else:
+            wait = False
+        client = ZEO.ClientStorage.ClientStorage(first, *args, **kw)
+    except:
+        _release(zkaddr, path)
+        raise
+    client = _client(addresses, client, zkaddr, path, selection, options,
+                     stats)
+    if wait:
+        _wait_connected(client, kw.get('wait_timeout'))
+    return client
+
+def _wait_connected(client, timeout=None):
+    """Wait for a client storage that was created without waiting.
+
+    Unlike ClientStorage._wait, the timeout applies to connecting,
+    not just to verifying the cache.
+    """
+    if not client._ready.wait(timeout):
+        logger.warning("%s Timed out waiting for connection",
+                       client.__name__)
+
+def open_client(zkaddr, path, callback, *args, **kw):
+    """Open a client storage without blocking.
+
+    callback is called with the storage, from a separate thread, once
+    there are server addresses.  If the storage can't be created,
+    errback, if given, is called with the exception, otherwise the
+    error is logged.
+    """
+    errback = kw.pop('errback', None)
+    options = _pop_options(kw)
+    # Don't block the ZooKeeper thread waiting to connect.
+    kw.pop('wait_for_server_on_startup', None)
+    kw['wait'] = False
+    stats = Stats()
+    start = time.time()
+    addresses = _acquire(zkaddr, path)
+    try:
+        selection = _selection(options, addresses)
+    except:
+        _release(zkaddr, path)
+        raise
+
+    def ready(_):
+        stats.waited(time.time() - start)
+
+        # We may be called from ZooKeeper's thread, and creating the
+        # storage can block, resolving names, probing servers and
+        # making a first connection attempt, so we do it in another.
+        @zc.thread.Thread
+        def zkzeo_open_thread():
+            try:
+                addrs = _transform(
+                    addresses, _address_transform(addresses, options, stats),
+                    selection)
+                client = ZEO.ClientStorage.ClientStorage(
+                    _first_choice(addrs, selection), *args, **kw)
+            except Exception as v:
+                _release(zkaddr, path)
+                if errback is None:
+                    logger.exception("Couldn't open client for <%s%s>",
+                                     zkaddr, path)
+                else:
+                    errback(v)
+            else:
+                callback(_client(addresses, client, zkaddr, path, selection,
+                                 options, stats))
+
+    _when_addresses(addresses, ready)
+
+def _pop_options(kw):
+    return dict((name, kw.pop(name, default))
+                for (name, default) in _options.items())
 
 def parse_addr(addr):
-    host, port = addr.split(':')
+    host, port = addr.rsplit(':', 1)
+    if host[:1] == '[' and host[-1:] == ']':
+        host = host[1:-1] # IPv6
     return host, int(port)
 
-def _client(addresses, client, zkaddr, path):
+def format_addr(addr):
+    host, port = addr[:2]
+    if ':' in host:
+        return '[%s]:%s' % (host, port) # IPv6
+    return '%s:%s' % (host, port)
+
+def _is_ipv6(addr):
+    return addr[:1] == '[' or addr.count(':') > 1
+
+_ipv6 = [] # Whether ZEO can connect to IPv6 addresses, once we know
+
+def _ipv6_supported():
+    if not _ipv6:
+        try:
+            from ZEO.zrpc.client import ConnectThread
+        except ImportError:
+            _ipv6.append(True)
+        else:
+            # ZEO 4's connect thread looks addresses up with
+            # getaddrinfo and AF_INET, which fails for IPv6 addresses.
+            class Manager:
+                addrlist = [(socket.AF_INET, ('::1', 1))]
+            thread = ConnectThread.__new__(ConnectThread)
+            thread.mgr = Manager()
+            try:
+                list(thread._expand_addrlist())
+            except socket.gaierror:
+                _ipv6.append(False)
+            else:
+                _ipv6.append(True)
+    return _ipv6[0]
+
+def _usable(addresses):
+    """Leave out addresses ZEO can't connect to
+    """
+    if _ipv6_supported():
+        return addresses
+    return [addr for addr in addresses if not _is_ipv6(addr)]
+
+# Host names resolved for clients with the resolve_ttl option
+_resolved = {} # {host -> (ip address, expiration time)}
+_resolved_lock = threading.Lock()
+_resolving = {} # {host -> [callback]} for hosts being resolved in threads
+
+def _numeric(host):
+    if not host or _is_ipv6(host):
+        return True
+    try:
+        socket.inet_aton(host)
+    except socket.error:
+        return False
+    return True
+
+def _resolve(host, ttl):
+    """Return an IP address for host, caching it for ttl seconds
 
-    new_addr = getattr(client, 'new_addr', None)
-    if new_addr is None:
+    If the host can't be resolved, the last address it resolved to
+    is used, if any, or the host itself, for ZEO to try.
+    """
+    if _numeric(host):
+        return host
+
+    now = time.time()
+    with _resolved_lock:
+        ip, expires = _resolved.get(host, (None, 0))
+    if expires > now:
+        return ip
+
+    family = socket.AF_UNSPEC if _ipv6_supported() else socket.AF_INET
+    try:
+        info = socket.getaddrinfo(host, None, family, socket.SOCK_STREAM)
+    except socket.error:
+        logger.warning("Couldn't resolve %r", host, exc_info=True)
+        return ip or host
+
+    ip = info[0][4][0]
+    with _resolved_lock:
+        _resolved[host] = ip, now + ttl
+        for name, (_, expires) in list(_resolved.items()):
+            if expires + ttl < now:
+                del _resolved[name] # Not used lately
+    return ip
+
+def _resolve_later(host, ttl, callback):
+    """Return an IP address for host without waiting for DNS
+
+    If host's address isn't cached, or has expired, host is resolved
+    in a separate thread, and callback is called if its address
+    changed.  Meanwhile, the last address it resolved to is returned,
+    if any, or the host itself.
+    """
+    if _numeric(host):
+        return host
+
+    with _resolved_lock:
+        ip, expires = _resolved.get(host, (None, 0))
+        if expires > time.time():
+            return ip
+        if host in _resolving:
+            _resolving[host].append(callback)
+            return ip or host
+        _resolving[host] = [callback]
+
+    @zc.thread.Thread
+    def zkzeo_resolve_thread():
+        try:
+            new = _resolve(host, ttl)
+        finally:
+            with _resolved_lock:
+                callbacks = _resolving.pop(host)
+        if new != (ip or host):
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception("Error handling address of %r", host)
+
+    return ip or host
+
+def _address_transform(addresses, options, stats, transform=parse_addr,
+                       local=str, resolved=None):
+    """Return a function that converts registered addresses for ZEO.
+
+    With the unix_sockets option, servers on this host that publish
+    Unix sockets are connected to over them.  Their addresses are
+    converted with local and the others with transform.
+
+    With the resolve_ttl option, host names are resolved, so ZEO
+    gets IP addresses.  If resolved is given, names are resolved in
+    the background, and resolved is called when an address changes.
+    """
+    unix_sockets = options.get('unix_sockets')
+    ttl = options.get('resolve_ttl')
+    if not (unix_sockets or ttl):
+        return transform
+
+    hostname = socket.gethostname()
+
+    def zeo_address(addr):
+        if unix_sockets:
+            try:
+                properties = addresses.session.get_properties(
+                    addresses.path + '/' + addr)
+            except zookeeper.NoNodeException:
+                properties = {} # It went away already
+            path = properties.get('unix_socket')
+            if (path and properties.get('hostname') == hostname
+                and os.path.exists(path)):
+                path = str(path)
+                stats.sockets[path] = addr
+                return local(path)
+        if ttl:
+            host, port = parse_addr(addr)
+            if resolved is None:
+                ip = _resolve(host, ttl)
+            else:
+                ip = _resolve_later(host, ttl, resolved)
+            ip = format_addr((ip, port))
+            if ip != addr:
+                stats.resolved[ip] = addr
+                return transform(ip)
+        return transform(addr)
+
+    return zeo_address
+
+def _client(addresses, client, zkaddr, path, selection=None,
+            options=_options, stats=None):
+
+    _new_addr = getattr(client, 'new_addr', None)
+    if _new_addr is None:
         # Pre 3.11 client.  We need to make our own new_addr.
         # This is ugly. Don't look. :(
-        def new_addr(addr):
+        def _new_addr(addr):
             manager = client._rpc_mgr
             manager.addrlist = manager._parse_addrs(addr)
             with manager.cond:
                 if manager.thread is not None:
                     manager.thread.addrlist = manager.addrlist
 
+    if stats is None:
+        stats = Stats()
+    stats.client = client
+    # We're called from ZooKeeper's thread, so we don't wait for DNS.
+    zeo_address = _address_transform(addresses, options, stats,
+                                     resolved=lambda : resolved())
+
+    preferring = selection is not None and selection.preferring
+    widened = [] # Whether ZEO was given more than our first choice
+    fallback = [] # The timer for falling back from our first choice
+
+    def new_addr(addrs):
+        if not widened:
+            addrs = _first_choice(addrs, selection)
+        start = time.time()
+        _new_addr(addrs)
+        stats.switched(addrs, time.time() - start)
+
+    if selection is None:
+        select = _usable
+    else:
+        select = lambda addresses: selection.select(_usable(addresses))
+
+    debounce = options['debounce']
+    on_change = options['on_change']
+    jitter = options['failover_jitter']
+    max_reconnects = options['max_reconnects']
+    standby = None
+    if options['standby']:
+        standby = Standby(client, options['standby'], stats)
+
     warned = set()
+    selected = []
+    registered = [] # The last set of addresses handled, sorted
+    closed = []
+    closing = threading.Event()
+    pending = [] # The timer for a debounced change, if any
+    failovers = [0] # Count of failovers, to detect newer ones
+    promoted = [] # The timer for going back from a standby, if any
+    held = [] # The timer for a held-back reconnect, if any
+    # Reentrant, because selections call update when they start
+    # watching registrations in handle_changed.
+    lock = threading.RLock()
 
-    @addresses
-    def changed(addresses):
-        addrs = map(parse_addr, addresses)
+    client.zookeeper_failover_delay = None
+
+    def apply_changed():
+        with lock:
+            if pending and pending[0] is not threading.current_thread():
+                return # We were superseded.
+            del pending[:]
+            if closed:
+                return
+            current = list(addresses)
+            if registered and registered[0] == sorted(current):
+                return # Nothing changed, maybe just the order.
+            if registered:
+                removed = set(registered[0]).difference(current)
+            else:
+                removed = ()
+            registered[:] = [sorted(current)]
+            handle_changed(current, removed)
+
+        # Outside the lock, so the callback can close the client.
+        if on_change is not None:
+            on_change(current)
+
+    def handle_changed(addresses, removed=()):
+        stats.changed(addresses)
+        addrs = map(zeo_address, select(addresses))
         if addrs:
             if warned:
                 logger.warning('OK: Addresses from <%s%s>', zkaddr, path)
@@ -59,50 +510,1450 @@ def _client(addresses, client, zkaddr, path):
         else:
             logger.warning('No addresses from <%s%s>', zkaddr, path)
             warned.add(1)
-        new_addr(addrs)
+        selected[:] = addrs
+        if standby is not None:
+            standby.addresses = select(addresses)
+        if (addrs and stats.server in removed and standby is not None
+            and standby.usable()):
+            promote()
+            migrate()
+        elif addrs and removed and (jitter or max_reconnects):
+            failover()
+        else:
+            new_addr(addrs)
+            if addrs and stats.server in removed:
+                migrate()
+        if selection is not None:
+            selection.changed(addresses)
+        if addresses and options['address_cache']:
+            _cache_addresses(options['address_cache'], zkaddr, path,
+                             addresses)
+
+    def resolved():
+        # A registered host name resolved to a new address.
+        with lock:
+            if closed or pending or not registered:
+                return # apply_changed will use it.
+            addrs = map(zeo_address, select(list(addresses)))
+            if addrs and addrs != selected:
+                selected[:] = addrs
+                if not promoted: # demote will use it.
+                    new_addr(addrs)
+
+    def failover():
+        # Servers went away.  Rather than have all of their clients
+        # descend on the remaining servers at once, wait a random
+        # time and limit the number of clients in this process
+        # reconnecting at once.
+        delay = random.uniform(0, jitter)
+        client.zookeeper_failover_delay = delay
+        stats.event('failover', delay=delay)
+        failovers[0] += 1
+        generation = failovers[0]
+        logger.info('Failing over from <%s%s> in %.3f seconds',
+                    zkaddr, path, delay)
+
+        @zc.thread.Thread
+        def zkzeo_failover_thread():
+            closing.wait(delay)
+            with _reconnecting_condition:
+                while (max_reconnects and not closing.is_set() and
+                       _reconnecting[0] >= max_reconnects):
+                    _reconnecting_condition.wait()
+                if closing.is_set() or generation != failovers[0]:
+                    return # A newer failover will take care of it.
+                _reconnecting[0] += 1
+            try:
+                new_addr(list(selected))
+                migrate()
+                if max_reconnects and not client.is_connected():
+                    # Hold our place until we've reconnected.
+                    client._ready.wait(_reconnect_timeout)
+            finally:
+                with _reconnecting_condition:
+                    _reconnecting[0] -= 1
+                    _reconnecting_condition.notifyAll()
+
+    def promote():
+        # Fail over to just our standby, which we know is up and
+        # caught up with our cache, right away.  We don't wait on
+        # servers that may be going away, or on the failover jitter,
+        # and ZEO doesn't try servers that are behind our cache.
+        # Called with the lock held.
+        address = standby.address
+        logger.info('Failing over from <%s%s> to standby %s',
+                    zkaddr, path, address)
+        stats.event('promoted', address=address)
+        new_addr([zeo_address(address)])
+        if promoted:
+            promoted.pop().cancel()
+        timer = threading.Timer(_reconnect_timeout, demote)
+        timer.setDaemon(True)
+        timer.setName('zkzeo_demote')
+        promoted.append(timer)
+        timer.start()
+
+    def demote():
+        # We connected to our standby, or gave up on it.  Either way,
+        # we don't want to depend on it alone.
+        with lock:
+            if promoted:
+                promoted.pop().cancel()
+                if not closed:
+                    new_addr(list(selected))
+
+    def migrate():
+        # If the server we're connected to was unregistered, it's
+        # probably draining, so move to another server.  We wait for
+        # the current transaction, if any, and hold up new transactions
+        # until we've reconnected, so they don't fail.
+        server = stats.server
+        if server is None or server in addresses:
+            return
+
+        @zc.thread.Thread
+        def zkzeo_migrate_thread():
+            # Take the storage's transaction slot, so new transactions
+            # wait for us, without holding its lock while we wait.
+            with client._tpc_cond:
+                while client._transaction is not None:
+                    if closing.is_set():
+                        return
+                    client._tpc_cond.wait(1)
+                connection = client._connection
+                if (closing.is_set() or connection is None or
+                    stats.server != server or server in addresses):
+                    return
+                client._transaction = migrating = object()
+            try:
+                logger.info('Leaving unregistered server %s', server)
+                stats.event('migrated', address=server)
+                # Connections must be closed by ZEO's asyncore thread.
+                connection.trigger.pull_trigger(connection.close)
+                deadline = time.time() + _migrate_timeout
+                while (client._connection is connection and
+                       not closing.is_set() and time.time() < deadline):
+                    closing.wait(.01)
+                client._ready.wait(max(deadline - time.time(), 0))
+            finally:
+                if client._transaction is migrating:
+                    client.end_transaction()
+
+    @addresses
+    def changed(addresses):
+        stats.notifications += 1
+        if debounce and registered:
+            # Wait for things to settle down, then handle the final
+            # set of addresses once.
+            with lock:
+                if pending:
+                    pending.pop().cancel()
+                timer = threading.Timer(debounce, apply_changed)
+                timer.setDaemon(True)
+                timer.setName('zkzeo_debounce')
+                pending.append(timer)
+                timer.start()
+        else:
+            apply_changed()
+
+    def update():
+        # Our selection's preferences changed.  We're called from
+        # selection threads and watches, and from handle_changed when
+        # the selection watches new registrations.
+        with lock:
+            if closed:
+                return
+            addrs = map(zeo_address, select(list(addresses)))
+            if addrs and addrs != selected:
+                logger.info('Selected %r from <%s%s>', addrs, zkaddr, path)
+                selected[:] = addrs
+                if not promoted: # demote will use it.
+                    new_addr(addrs)
+
+    def connecting():
+        # ZEO is trying to connect.  If it can't connect to our first
+        # choice soon, we let it try the others.
+        with lock:
+            if closed or fallback or widened:
+                return
+            timer = threading.Timer(_fallback_delay, fall_back)
+            timer.setDaemon(True)
+            fallback.append(timer)
+        timer.start()
+
+    def fall_back():
+        with lock:
+            del fallback[:]
+            if closed or client.is_connected() or len(selected) < 2:
+                return
+            address = selected[0]
+            if isinstance(address, tuple):
+                address = format_addr(address)
+            logger.warning("Couldn't connect to %s from <%s%s>,"
+                           " trying the others", address, zkaddr, path)
+            stats.event('fallback', address=address)
+            widened.append(1)
+            new_addr(list(selected))
+
+    def connected():
+        with lock:
+            if fallback:
+                fallback.pop().cancel()
+            if widened and not closed:
+                # Try our first choice again when we reconnect.
+                del widened[:]
+                new_addr(list(selected))
+
+    if jitter or standby is not None:
+        # ZEO reconnects as soon as it loses its connection.  If the
+        # server crashed, it's still registered, so we haven't failed
+        # over yet.  If our standby is usable, we reconnect to it right
+        # away.  Otherwise, we hold ZEO's reconnect back for a random
+        # time, so the server's clients don't all descend on the others
+        # at once.
+        manager = client._rpc_mgr
+        connect = manager.connect
+        lost = [] # The registered server, if we lost its connection
+
+        def reconnect():
+            with lock:
+                del held[:]
+                if closed or manager.closed:
+                    return
+            connect()
+
+        def _connect(sync=0):
+            with lock:
+                server = lost and lost.pop()
+                if (sync or not server or closed or
+                    server not in addresses):
+                    server = None
+                elif (standby is not None and standby.usable() and
+                      standby.address != server):
+                    promote()
+                    server = None
+                elif not jitter:
+                    server = None
+                else:
+                    delay = random.uniform(0, jitter)
+                    client.zookeeper_failover_delay = delay
+                    stats.event('failover', delay=delay, address=server)
+                    logger.info('Reconnecting after losing %s from <%s%s>'
+                                ' in %.3f seconds',
+                                server, zkaddr, path, delay)
+                    timer = threading.Timer(delay, reconnect)
+                    timer.setDaemon(True)
+                    timer.setName('zkzeo_reconnect')
+                    if held:
+                        held.pop().cancel()
+                    held.append(timer)
+            if server is None:
+                return connect(sync)
+            timer.start()
+        manager.connect = _connect
+
+        notifyLost = client.notifyDisconnected
+        def _notifyLost():
+            connection = client._connection
+            if connection is not None:
+                with lock:
+                    lost[:] = [stats.registered(connection.addr)]
+            notifyLost()
+        client.notifyDisconnected = _notifyLost
+
+    if standby is not None:
+        notifyPromoted = client.notifyConnected
+        def _notifyPromoted(*args):
+            notifyPromoted(*args)
+            demote()
+        client.notifyConnected = _notifyPromoted
+
+    if preferring:
+        notifyConnected = client.notifyConnected
+        def _notifyConnected(*args):
+            notifyConnected(*args)
+            connected()
+        client.notifyConnected = _notifyConnected
+
+        notifyDisconnected = client.notifyDisconnected
+        def _notifyDisconnected():
+            notifyDisconnected()
+            connecting()
+        client.notifyDisconnected = _notifyDisconnected
+
+        if not client.is_connected():
+            connecting()
 
     client.zookeeper_addresses = addresses
+    client.zookeeper_selection = selection
+    client.zookeeper_stats = stats
+    client.zookeeper_standby = standby
+    if selection is not None:
+        selection.update = update
+        selection.start()
+    if standby is not None:
+        standby.start()
+
+    close = client.close
+    released = []
+    def _close():
+        with lock:
+            closed.append(1)
+            if pending:
+                pending.pop().cancel()
+            if fallback:
+                fallback.pop().cancel()
+            if held:
+                held.pop().cancel()
+            if promoted:
+                promoted.pop().cancel()
+        closing.set()
+        with _reconnecting_condition:
+            _reconnecting_condition.notifyAll()
+        try:
+            close()
+        finally:
+            # Storages may be closed more than once.
+            if not released:
+                released.append(1)
+                if selection is not None:
+                    selection.stop()
+                if standby is not None:
+                    standby.stop()
+                _release(zkaddr, path, changed)
+    client.close = _close
 
     return client
 
-def _wait_addresses(addresses, transform, zkaddr, path, wait):
-    n = 0
+# How long to wait between attempts to connect to ZooKeeper when
+# starting with cached addresses, in seconds.
+_reconcile_interval = 10
+
+def _reconcile(client, zkaddr, path, options, stats):
+    """Hook up a client started with cached addresses to ZooKeeper.
+
+    This connects to ZooKeeper in a thread, so it doesn't block.
+    """
+    lock = threading.Lock()
+    closed = threading.Event()
+    close = client.close
+    def _close():
+        with lock:
+            closed.set()
+            current = client.close
+        if current is _close:
+            close()
+        else:
+            # We were hooked up while waiting for the lock.
+            current()
+    client.close = _close
+
+    @zc.thread.Thread
+    def zkzeo_reconcile_thread():
+        while not closed.is_set():
+            try:
+                addresses = _acquire(zkaddr, path)
+            except Exception:
+                logger.exception("Couldn't get addresses from <%s%s>",
+                                 zkaddr, path)
+                closed.wait(_reconcile_interval)
+                continue
+            with lock:
+                try:
+                    if closed.is_set():
+                        raise ValueError("Closed")
+                    selection = _selection(options, addresses)
+                except:
+                    _release(zkaddr, path)
+                    if not closed.is_set():
+                        logger.exception("Couldn't use <%s%s>", zkaddr, path)
+                    return
+                if selection is not None:
+                    selection.prepare(list(addresses))
+                client.close = close
+                _client(addresses, client, zkaddr, path, selection, options,
+                        stats)
+            return
+
+    return client
+
+# Address caches are shared by clients in a process.  Changes are
+# saved by a single thread, so ZooKeeper's thread doesn't wait on the
+# file system, and changes made while saving are saved together.
+_cache_lock = threading.Lock()
+_cache_pending = {} # {cache -> {key -> addresses}}
+_cache_saving = [] # Non-empty while a thread is saving changes
+
+def _cache_key(zkaddr, path):
+    return zkaddr + path
+
+def _cached_addresses(cache, zkaddr, path):
+    """Return the cached addresses for a path, or None
+    """
+    if not cache:
+        return None
+    try:
+        with open(cache) as f:
+            addresses = json.load(f).get(_cache_key(zkaddr, path))
+    except (IOError, ValueError):
+        return None
+    return _usable([str(addr) for addr in addresses or ()]) or None
+
+def _cache_addresses(cache, zkaddr, path, addresses):
+    """Save addresses in an address cache, in the background.
+    """
+    with _cache_lock:
+        _cache_pending.setdefault(cache, {})[_cache_key(zkaddr, path)] = (
+            sorted(addresses))
+        if _cache_saving:
+            return # The saving thread will get to it.
+        _cache_saving.append(1)
+
+    @zc.thread.Thread
+    def zkzeo_address_cache_thread():
+        while 1:
+            with _cache_lock:
+                if not _cache_pending:
+                    del _cache_saving[:]
+                    return
+                cache, changes = _cache_pending.popitem()
+            try:
+                _save_addresses(cache, changes)
+            except Exception:
+                logger.exception("Couldn't save addresses in %s", cache)
+
+def _save_addresses(cache, changes):
+    """Update an address cache with changes, a dict of cached addresses.
+
+    The cache is replaced atomically, so readers never see a partial
+    cache, even if we crash.
+    """
+    try:
+        with open(cache) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        data = {}
+    if all(data.get(key) == addresses
+           for (key, addresses) in changes.items()):
+        return
+    data.update(changes)
+    tmp = '%s.%s.tmp' % (cache, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, cache)
+
+def snapshot_cache(storage, path):
+    """Save a snapshot of a client storage's cache in a file.
+
+    The snapshot is a ZEO cache file with the current objects in the
+    cache.  Other clients can start with it by passing its path as the
+    cache_snapshot option.
+    """
+    cache = storage._cache
+    # Get the last transaction first.  If objects change while we
+    # copy them, they'll be invalidated when the snapshot is used.
+    tid = cache.getLastTid()
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    snapshot = ZEO.cache.ClientCache(tmp, size=cache.maxsize)
+    try:
+        snapshot.setLastTid(tid)
+        with cache._lock:
+            oids = list(cache.current)
+        for oid in oids:
+            loaded = cache.load(oid)
+            if loaded is not None:
+                data, serial = loaded
+                snapshot.store(oid, serial, None, data)
+        count = len(snapshot)
+    finally:
+        snapshot.close()
+        os.remove(tmp + '.lock')
+    os.rename(tmp, path)
+    return count
+
+def _prewarm(snapshot, client, var, storage, stats):
+    """Seed a persistent client cache from a snapshot.
+
+    This is only done if the client has a persistent cache that
+    doesn't exist yet.
+    """
+    if not (snapshot and client):
+        return
+    path = os.path.join(var or os.getcwd(), "%s-%s.zec" % (client, storage))
+    if os.path.exists(path):
+        return
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        with open(snapshot, 'rb') as f:
+            if f.read(len(ZEO.cache.magic)) != ZEO.cache.magic:
+                logger.warning("%s isn't a ZEO cache file", snapshot)
+                return
+            f.seek(0)
+            with open(tmp, 'wb') as out:
+                shutil.copyfileobj(f, out)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        logger.warning("Couldn't use cache snapshot %s", snapshot,
+                       exc_info=True)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return
+    logger.info("Cache %s prewarmed from %s", path, snapshot)
+    stats.event('prewarmed', snapshot=snapshot)
+
+class Stats:
+    """Statistics and events for a zkzeo client storage.
+
+    Events are dictionaries with name and time items and items
+    specific to the event.  Recent events are kept in the events
+    attribute, and functions in the hooks attribute are called with
+    each event.
+    """
+
+    history_length = 3600 # Seconds of events to keep
+
+    def __init__(self):
+        self.client = None
+        self.wait_seconds = 0.0 # Time spent waiting for addresses to open
+        self.notifications = 0 # ZooKeeper notifications received
+        self.changes = 0 # Address changes handled
+        self.switchovers = 0 # Times ZEO was given new addresses
+        self.switchover_seconds = None # Time the last switchover took
+        self.addresses = [] # Addresses ZEO was last given
+        self.sockets = {} # {Unix socket -> registered address}
+        self.resolved = {} # {resolved address -> registered address}
+        self.events = []
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    @property
+    def server(self):
+        """The address of the server we're connected to, if any
+        """
+        client = self.client
+        connection = getattr(client, '_connection', None)
+        if connection is None or not client.is_connected():
+            return None
+        return self.registered(connection.addr)
+
+    def registered(self, addr):
+        """The registered address for an address ZEO connected to
+        """
+        if isinstance(addr, tuple):
+            addr = format_addr(addr)
+            addr = self.resolved.get(addr, addr)
+        else:
+            addr = self.sockets.get(addr, addr)
+        return addr
+
+    def waited(self, seconds):
+        self.wait_seconds = seconds
+        self.event('waited', seconds=seconds)
+
+    def changed(self, addresses):
+        self.changes += 1
+        self.event('changed', addresses=sorted(addresses))
+
+    def switched(self, addresses, seconds):
+        self.switchovers += 1
+        self.switchover_seconds = seconds
+        self.addresses = [(format_addr(addr) if isinstance(addr, tuple)
+                           else addr)
+                          for addr in addresses]
+        self.event('switched', addresses=self.addresses, seconds=seconds)
+
+    def event(self, name, **event):
+        event.update(name=name, time=time.time())
+        with self.lock:
+            self.events.append(event)
+            cutoff = event['time'] - self.history_length
+            while self.events[0]['time'] < cutoff:
+                self.events.pop(0)
+        for hook in list(self.hooks):
+            try:
+                hook(event)
+            except Exception:
+                logger.exception("Error in zkzeo stats hook")
+
+    def as_dict(self):
+        return dict(
+            wait_seconds=self.wait_seconds,
+            notifications=self.notifications,
+            changes=self.changes,
+            switchovers=self.switchovers,
+            switchover_seconds=self.switchover_seconds,
+            addresses=list(self.addresses),
+            server=self.server,
+            )
+
+class ActivityMonitor(ZODB.ActivityMonitor.ActivityMonitor):
+    """A ZODB activity monitor that also reports zkzeo client activity.
+
+    Activity-analysis divisions include counts of the address changes
+    and switchovers of the database's zkzeo client storage.
+    """
+
+    stats = None
+
+    def closedConnection(self, conn):
+        if self.stats is None:
+            self.stats = getattr(conn.db().storage, 'zookeeper_stats', None)
+        ZODB.ActivityMonitor.ActivityMonitor.closedConnection(self, conn)
+
+    def getActivityAnalysis(self, start=0, end=0, divisions=10):
+        res = ZODB.ActivityMonitor.ActivityMonitor.getActivityAnalysis(
+            self, start, end, divisions)
+        for div in res:
+            div['zookeeper_changes'] = div['zookeeper_switchovers'] = 0
+        if self.stats is not None:
+            with self.stats.lock:
+                events = list(self.stats.events)
+            for event in events:
+                name = dict(changed='zookeeper_changes',
+                            switched='zookeeper_switchovers',
+                            ).get(event['name'])
+                if name is None:
+                    continue
+                for div in res:
+                    if div['start'] <= event['time'] <= div['end']:
+                        div[name] += 1
+                        break
+        return res
+
+class Standby:
+    """Keep a second server checked, so we can fail over to it quickly.
+
+    Every interval seconds, the first selected server we aren't
+    connected to is asked for its status.  It's usable if it answered
+    the last time we asked, and it had committed the last transaction
+    our cache has seen.  ZEO won't use a server that's behind the
+    client's cache.
+    """
+
+    timeout = 1.0 # Status request timeout
+
+    def __init__(self, client, interval, stats=None):
+        self.client = client
+        self.interval = interval
+        self.stats = stats
+        self.addresses = [] # Selected addresses, most preferred first
+        self.address = None # The checked server, if it answered
+        self.last_transaction = None # Its last transaction, in hex
+        self.event = threading.Event()
+        self.stopped = False
+
+    def check(self):
+        connected = self.stats.server if self.stats is not None else None
+        address = last_transaction = None
+        for addr in self.addresses:
+            if addr != connected:
+                try:
+                    status = zc.zkzeo.status.ruok(addr, self.timeout)
+                    last_transaction = status[self.client._storage][
+                        'last-transaction']
+                except Exception:
+                    logger.warning("Couldn't check standby %s", addr,
+                                   exc_info=True)
+                else:
+                    address = addr
+                break
+        if address != self.address and self.stats is not None:
+            self.stats.event('standby', address=address)
+        self.address, self.last_transaction = address, last_transaction
+        return address
+
+    def usable(self):
+        address = self.address
+        if address is None or address not in self.addresses:
+            return False
+        tid = self.client._cache.getLastTid()
+        if tid is None:
+            return True # Our cache hasn't seen any transactions.
+        return self.last_transaction >= binascii.hexlify(tid)
+
+    def start(self):
+        @zc.thread.Thread
+        def zkzeo_standby_thread():
+            while not self.stopped:
+                try:
+                    self.check()
+                except Exception:
+                    logger.exception("Error checking standby")
+                self.event.wait(self.interval)
+
+    def stop(self):
+        self.stopped = True
+        self.event.set()
+
+class Selection:
+    """Base class for server-selection policies.
+
+    Selections are called with a list of registered addresses and
+    return the addresses in order of preference.  When a selection's
+    preferences change, it calls its update attribute.
+
+    The base class has no preferences, but if a max_lag option is
+    given, it filters out servers whose last transactions lag the
+    most recent by more than max_lag seconds.
+    """
+
+    # If a selection has preferences, ZEO is given only the preferred
+    # address, because it tries all of the addresses it's given at
+    # once and uses the first to answer.  If it can't connect to the
+    # preferred address, it's given the rest.
+    preferring = False
+
+    # Whether to watch the properties of server registrations.
+    uses_properties = False
+
+    def __init__(self, options, addresses=None):
+        self.options = options
+        self.addresses = addresses # zc.zk.Children
+        self.max_lag = options.get('max_lag')
+        self.properties = {} # {addr -> zc.zk.Properties}
+        self.metrics = {} # {addr -> zc.zk.Properties of published metrics}
+        self.stopped = False
+
+    def __call__(self, addresses):
+        return addresses
+
+    def select(self, addresses):
+        """Return the addresses to give ZEO, most preferred first
+        """
+        return self(self.fresh(addresses))
+
+    def prepare(self, addresses):
+        """Get ready to select from the initial addresses
+        """
+        self.watch(addresses)
+
+    def start(self):
+        """Start any background work
+        """
+
+    def changed(self, addresses):
+        """The registered addresses changed
+        """
+        self.watch(addresses)
+
+    def stop(self):
+        self.stopped = True
+        self.properties.clear()
+        self.metrics.clear()
+
+    def update(self):
+        pass
+
+    def watch(self, addresses):
+        # Keep watches on the registrations of the current servers.
+        if not (self.uses_properties or self.max_lag):
+            return
+        for addr in list(self.properties):
+            if addr not in addresses:
+                del self.properties[addr]
+                self.metrics.pop(addr, None)
+        for addr in addresses:
+            if addr not in self.properties:
+                try:
+                    properties = self.addresses.session.properties(
+                        self.addresses.path + '/' + addr)
+                except zookeeper.NoNodeException:
+                    continue # It went away already
+                properties(self.properties_changed)
+                self.properties[addr] = properties
+                path = properties.get('metrics')
+                if path:
+                    # The server publishes metrics on a separate node.
+                    try:
+                        metrics = self.addresses.session.properties(path)
+                    except zookeeper.NoNodeException:
+                        continue
+                    self.metrics[addr] = metrics
+                    metrics(self.properties_changed)
+
+    def properties_changed(self, properties=None):
+        if self.stopped:
+            raise zc.zk.CancelWatch()
+        if properties is not None:
+            self.update()
+
+    def server(self, addr):
+        """Return a key for the server that registered an address
+
+        Servers listening on several interfaces register an address
+        for each of them.
+        """
+        hostname = self.property(addr, 'hostname')
+        pid = self.property(addr, 'pid')
+        if hostname and pid:
+            return '%s:%s' % (hostname, pid)
+        return addr
+
+    def property(self, addr, name, default=None):
+        metrics = self.metrics.get(addr)
+        if metrics is not None and name in metrics:
+            return metrics[name]
+        properties = self.properties.get(addr)
+        if properties is None:
+            return default
+        return properties.get(name, default)
+
+    def transaction_time(self, addr):
+        tid = self.property(addr, 'last_transaction')
+        if not tid:
+            return None
+        try:
+            return ZODB.TimeStamp.TimeStamp(
+                binascii.unhexlify(tid)).timeTime()
+        except (TypeError, ValueError):
+            return None
+
+    def fresh(self, addresses):
+        if not self.max_lag:
+            return addresses
+        times = dict((addr, self.transaction_time(addr))
+                     for addr in addresses)
+        known = [t for t in times.values() if t is not None]
+        if not known:
+            return addresses
+        newest = max(known)
+        # Servers that don't tell us their last transactions get the
+        # benefit of the doubt.
+        return [addr for addr in addresses
+                if times[addr] is None or newest - times[addr] <= self.max_lag]
+
+class LatencySelection(Selection):
+    """Prefer the servers with the lowest measured round-trip times.
+
+    Servers are probed by connecting to them on startup, when
+    registrations change and every probe_interval seconds.  We keep an
+    exponential moving average of the connect times.
+    """
+
+    preferring = True
+    timeout = 1.0 # Probe connect timeout
+    weight = .3   # Weight of a new measurement in the average
+
+    def __init__(self, options, addresses=None):
+        Selection.__init__(self, options, addresses)
+        self.rtt = {} # {addr -> seconds, or None if unreachable}
+        self.probing = []
+        self.event = threading.Event()
+
+    def probe(self, addr):
+        start = time.time()
+        try:
+            sock = socket.create_connection(parse_addr(addr), self.timeout)
+        except socket.error:
+            return None
+        sock.close()
+        return time.time() - start
+
+    def measure(self, addresses):
+        # Probe the servers at once, so slow or unreachable servers
+        # don't add up.
+        probed = {}
+        def zkzeo_latency_probe(addr):
+            probed[addr] = self.probe(addr)
+        threads = [zc.thread.Thread(zkzeo_latency_probe, args=(addr,))
+                   for addr in addresses]
+        deadline = time.time() + self.timeout + 1
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+
+        # Servers that haven't answered are unreachable.
+        rtts = {}
+        for addr in addresses:
+            rtt = probed.get(addr)
+            old = self.rtt.get(addr)
+            if rtt is not None and old is not None:
+                rtt = old + self.weight * (rtt - old)
+            rtts[addr] = rtt
+        self.rtt = rtts
+
+    def __call__(self, addresses):
+        def key(addr):
+            if addr not in self.rtt:
+                return 1, 0 # not measured yet
+            rtt = self.rtt[addr]
+            if rtt is None:
+                return 2, 0 # unreachable
+            return 0, rtt
+        return sorted(addresses, key=key)
+
+    def prepare(self, addresses):
+        Selection.prepare(self, addresses)
+        self.probing = addresses
+        self.measure(addresses)
+
+    def start(self):
+        @zc.thread.Thread
+        def zkzeo_latency_probe_thread():
+            while 1:
+                self.event.wait(self.options['probe_interval'])
+                if self.stopped:
+                    break
+                self.event.clear()
+                self.measure(self.probing)
+                self.update()
+
+    def changed(self, addresses):
+        Selection.changed(self, addresses)
+        if sorted(addresses) != sorted(self.probing):
+            self.probing = addresses
+            self.event.set()
+
+    def stop(self):
+        Selection.stop(self)
+        self.event.set()
+
+class HashSelection(Selection):
+    """Spread clients over servers by hashing their client ids.
+
+    This uses rendezvous hashing, so when a server is added or
+    removed, only the clients that would use that server move.
+    Servers, rather than addresses, are hashed, so a server with
+    several addresses isn't chosen more often.
+    """
+
+    preferring = True
+    uses_properties = True # To know which addresses are whose
+
+    def __init__(self, options, addresses=None):
+        Selection.__init__(self, options, addresses)
+        self.key = self.options.get('client_id') or self.default_key()
+
+    def default_key(self):
+        return '%s:%s' % (socket.gethostname(), os.getpid())
+
+    def score(self, addr):
+        return hashlib.md5('%s %s' % (self.key, addr)).hexdigest()
+
+    def __call__(self, addresses):
+        return sorted(addresses,
+                      key=lambda addr: (self.score(self.server(addr)), addr))
+
+class RandomSelection(HashSelection):
+    """Use a random server.
+
+    Each client picks a server at random.  The choice is stable:
+    a client only moves if the server it's using is unregistered.
+    """
+
+    def default_key(self):
+        return binascii.hexlify(os.urandom(8))
+
+class LeastConnectionsSelection(RandomSelection):
+    """Prefer the server with the fewest connections.
+
+    This uses the ``connections`` property servers publish in their
+    registrations.  Servers that don't publish it are used last.  Ties
+    are broken randomly.
+    """
+
+    uses_properties = True
+
+    def load(self, addr):
+        try:
+            return int(self.property(addr, 'connections'))
+        except (TypeError, ValueError):
+            return float('inf')
+
+    def __call__(self, addresses):
+        return sorted(addresses,
+                      key=lambda addr: (self.load(addr),
+                                        self.score(self.server(addr)), addr))
+
+class WeightedSelection(RandomSelection):
+    """Spread clients over servers in proportion to their weights.
+
+    This uses the ``weight`` and ``zone`` properties servers publish in
+    their registrations.  If the client has a zone and servers in it
+    are registered, they're preferred.  Servers that don't publish a
+    weight have a weight of 1, and servers with weights of 0 or less
+    are used last, even if they're in the client's zone.
+
+    This uses weighted rendezvous hashing, so, as with hash selection,
+    only the clients that would use a server move when it's added or
+    removed.
+    """
+
+    uses_properties = True
+
+    def __init__(self, options, addresses=None):
+        RandomSelection.__init__(self, options, addresses)
+        self.zone = self.options.get('zone')
+
+    def weight(self, addr):
+        try:
+            return float(self.property(addr, 'weight', 1))
+        except (TypeError, ValueError):
+            return 1.0
+
+    def weighted_score(self, addr, weight):
+        # Map the hash to (0, 1).  Taking -log(h) / weight makes the
+        # chance of having the lowest score proportional to weight.
+        h = (int(self.score(addr), 16) + 1.0) / (2**128 + 1.0)
+        return -math.log(h) / weight
+
+    def __call__(self, addresses):
+        def key(addr):
+            weight = self.weight(addr)
+            if weight <= 0:
+                return 2, 0, addr
+            remote = bool(self.zone and
+                          self.property(addr, 'zone') != self.zone)
+            return (int(remote),
+                    self.weighted_score(self.server(addr), weight), addr)
+        return sorted(addresses, key=key)
+
+selections = {
+    'latency': LatencySelection,
+    'random': RandomSelection,
+    'hash': HashSelection,
+    'least-connections': LeastConnectionsSelection,
+    'weighted': WeightedSelection,
+    }
+
+def _selection(options, addresses=None):
+    name = options['selection']
+    if name is None:
+        if options.get('max_lag'):
+            return Selection(options, addresses)
+        return None
+    try:
+        factory = selections[name]
+    except KeyError:
+        raise ValueError("Unknown selection, %r" % name)
+    return factory(options, addresses)
+
+# How often to complain while waiting for addresses, in seconds.
+_warn_interval = 300
+
+def _wait_addresses(addresses, transform, zkaddr, path, wait, timeout=None,
+                    selection=None):
+    result = _transform(addresses, transform, selection)
+    if result or not wait:
+        return result
+
+    # Rather than polling, block until the children watch tells us
+    # there are addresses.
+    event = threading.Event()
+    _when_addresses(addresses, lambda addresses: event.set())
+    logger.warning("No addresses from <%s%s>", zkaddr, path)
+    if timeout is not None:
+        deadline = time.time() + timeout
     while 1:
-        result = [transform(addr) for addr in addresses]
-        if result:
-            if n:
-                logger.warning("OK: Got addresses from <%s%s>",
-                               zkaddr, path)
-            return result
-        if not wait:
+        if timeout is None:
+            event.wait(_warn_interval)
+        else:
+            event.wait(max(min(_warn_interval, deadline - time.time()), 0))
+        if event.is_set():
+            result = _transform(addresses, transform, selection)
+            if result:
+                logger.warning("OK: Got addresses from <%s%s>", zkaddr, path)
+                return result
+            # The addresses went away again before we could use them.
+            event.clear()
+            _when_addresses(addresses, lambda addresses: event.set())
+        elif timeout is not None and time.time() >= deadline:
+            logger.warning("Timed out waiting for addresses from <%s%s>",
+                           zkaddr, path)
             return result
-        if (n%30000) == 0: # warn every few minutes
+        else:
             logger.warning("No addresses from <%s%s>", zkaddr, path)
-        time.sleep(.01)
-        n += 1
+
+def _first_choice(addrs, selection):
+    # ZEO uses the first address it can connect to, so we give it just
+    # a preferring selection's first choice, at first.
+    if selection is not None and selection.preferring:
+        return addrs[:1]
+    return addrs
+
+def _transform(addresses, transform, selection):
+    addresses = _usable(list(addresses))
+    if selection is not None and addresses:
+        selection.prepare(addresses)
+        addresses = selection.select(addresses)
+    return [transform(addr) for addr in addresses]
+
+def _when_addresses(addresses, callback):
+    """Call callback(addresses) once there are addresses ZEO can use.
+
+    This doesn't block.  If there are already addresses, the callback
+    is called right away, otherwise, it's called from the ZooKeeper
+    children watch when addresses show up.
+    """
+    lock = threading.Lock()
+    called = []
+
+    def notify(addresses):
+        with lock:
+            if called:
+                raise zc.zk.CancelWatch()
+            if not _usable(list(addresses)):
+                return
+            called.append(1)
+        callback(addresses)
+
+    addresses(notify)
+    if called and notify in addresses.callbacks:
+        addresses.callbacks.remove(notify)
+
+class Databases:
+    """The databases registered below a ZooKeeper path, by name.
+
+    The names are the children of the path, which are tracked with a
+    single children watch.  A database is opened, with factory, the
+    first time it's looked up, and its client then watches its own
+    path.  When a name is removed from ZooKeeper, its database is
+    closed.
+    """
+
+    def __init__(self, zkaddr, path, factory, args, kw):
+        self.zkaddr = zkaddr
+        self.path = path.rstrip('/')
+        self.factory = factory
+        self.args = args
+        self.kw = kw
+        self.databases = {} # {name -> opened database}
+        self.lock = threading.Lock()
+        self.opening = {} # {name -> lock held while opening it}
+        self.closed = False
+        self.names = _acquire(zkaddr, self.path)
+        self.names(self.changed)
+
+    def changed(self, names):
+        if self.closed:
+            raise zc.zk.CancelWatch()
+        with self.lock:
+            removed = [self.databases.pop(name)
+                       for name in list(self.databases)
+                       if name not in names]
+            for name in list(self.opening):
+                if name not in names:
+                    del self.opening[name]
+        for db in removed:
+            db.close()
+
+    def keys(self):
+        return sorted(self.names)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(list(self.names))
+
+    def __contains__(self, name):
+        return name in list(self.names)
+
+    def _get(self, name):
+        with self.lock:
+            if self.closed:
+                raise ValueError("Databases are closed")
+            db = self.databases.get(name)
+        if db is None and name not in self:
+            raise KeyError(name)
+        return db
+
+    def __getitem__(self, name):
+        db = self._get(name)
+        if db is not None:
+            return db
+        # Opening a database may block, waiting for its servers, so we
+        # only make lookups of the same name wait for each other.
+        with self.lock:
+            opening = self.opening.get(name)
+            if opening is None:
+                opening = self.opening[name] = threading.Lock()
+        with opening:
+            db = self._get(name)
+            if db is not None:
+                return db
+            # Open without holding self.lock, because the ZooKeeper
+            # thread may need it to tell the client about its addresses.
+            db = self.factory(self.zkaddr, self.path + '/' + name,
+                              *self.args, **self.kw)
+            with self.lock:
+                if self.closed or name not in self:
+                    # We were closed or the database went away.
+                    db.close()
+                    raise KeyError(name)
+                self.databases[name] = db
+            return db
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def opened(self):
+        """Return the names of the databases that have been opened
+        """
+        with self.lock:
+            return sorted(self.databases)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            databases = self.databases.values()
+            self.databases.clear()
+            self.opening.clear()
+        _release(self.zkaddr, self.path, self.changed)
+        for db in databases:
+            db.close()
+
+class LazyDB:
+    """A database that isn't opened until it's used.
+
+    The ZooKeeper watch on the database's path is set up right away,
+    so the addresses are at hand when they're needed, but the client
+    storage, with its ZEO connection and cache, and the database
+    aren't created, by calling open, until an attribute of the
+    database is first used.
+
+    If databases, a multi-database mapping, is given, the lazy
+    database stands in for the database in it until it's opened.
+    """
+
+    def __init__(self, zkaddr, path, open, database_name=None,
+                 databases=None):
+        self._zkaddr = zkaddr
+        self._path = path
+        self._open = open
+        self._db = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._addresses = _acquire(zkaddr, path)
+        self._database_name = database_name
+        self._databases = databases
+        if databases is not None:
+            if database_name in databases:
+                _release(zkaddr, path)
+                raise ValueError("database_name %r already in databases" %
+                                 database_name)
+            databases[database_name] = self
+
+    def _get(self):
+        with self._lock:
+            if self._db is None:
+                if self._closed:
+                    raise ValueError("Database is closed")
+                databases = self._databases
+                name = self._database_name
+                if databases is not None and databases.get(name) is self:
+                    # Make room for the real database.
+                    del databases[name]
+                try:
+                    self._db = self._open()
+                except:
+                    if databases is not None and name not in databases:
+                        databases[name] = self
+                    raise
+                # The client has its own watch now.
+                _release(self._zkaddr, self._path)
+            return self._db
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._get(), name)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            db = self._db
+            if db is None:
+                _release(self._zkaddr, self._path)
+                databases = self._databases
+                if (databases is not None and
+                    databases.get(self._database_name) is self):
+                    del databases[self._database_name]
+        if db is not None:
+            db.close()
 
 class ZConfig:
 
     def __init__(self, config):
         self.config = config
         self.name = config.getSectionName()
+        self.opened = [] # A storage opened ahead of time by open_storages
+        self.deferred = False # Whether we're opened by a LazyDB
 
-    def open(self):
-        import ZConfig.datatypes
-        import ZODB.config
-
-        zkaddr = self.config.zookeeper
-        zk = zc.zk.ZooKeeper(zkaddr)
+    def path(self):
+        """Return the ZooKeeper path given with the server option
+        """
         paths = [server.address for server in self.config.server]
         if len(paths) > 1:
             raise TypeError("Only one server option is allowed")
         path = paths[0]
         if not isinstance(path, basestring) or not path[0] == '/':
             raise TypeError("server must be a ZooKeeper path, %r" % path)
-        addresses = zk.children(path)
-        self.config.server = _wait_addresses(
-            addresses, ZConfig.datatypes.SocketAddress,
-            zkaddr, path, self.config.wait)
+        return path
+
+    def open(self):
+        import ZConfig.datatypes
+        import ZODB.config
+
+        if self.opened:
+            return self.opened.pop()
+
+        zkaddr = self.config.zookeeper
+        path = self.path()
+        if self.config.lazy and not self.deferred:
+            # ZODB.DB loads the root object as soon as it's created,
+            # so we can't put off opening the storage.
+            logger.warning(
+                "The %s storage for <%s%s> is lazy, but it's being opened"
+                " right away.  Lazy storages are only supported by"
+                " zc.zkzeo.databaseFromString and databaseFromFile.",
+                self.name or 'zkzeoclient', zkaddr, path)
+        options = dict((name, getattr(self.config, name, default))
+                       for (name, default) in _options.items())
+        stats = Stats()
+        _prewarm(options['cache_snapshot'], self.config.client,
+                 self.config.var, self.config.storage, stats)
+
+        cached = _cached_addresses(options['address_cache'], zkaddr, path)
+        if cached:
+            stats.waited(0.0)
+            self.config.server = map(ZConfig.datatypes.SocketAddress, cached)
+            wait, self.config.wait = self.config.wait, False
+            client = ZODB.config.ZEOClient(self.config).open()
+            client = _reconcile(client, zkaddr, path, options, stats)
+            if wait:
+                _wait_connected(client, self.config.wait_timeout)
+            return client
+
+        addresses = _acquire(zkaddr, path)
+        try:
+            selection = _selection(options, addresses)
+            start = time.time()
+            addrs = _wait_addresses(
+                addresses,
+                _address_transform(addresses, options, stats,
+                                   ZConfig.datatypes.SocketAddress,
+                                   ZConfig.datatypes.SocketAddress),
+                zkaddr, path, self.config.wait, self.config.wait_timeout,
+                selection)
+            stats.waited(time.time() - start)
+            self.config.server = _first_choice(addrs, selection)
+            wait = self.config.wait and bool(addrs)
+            if wait and self.config.server != addrs:
+                # Wait once we can fall back to the other addresses.
+                self.config.wait = False
+            else:
+                self.config.wait = wait
+                wait = False
+
+            client = ZODB.config.ZEOClient(self.config).open()
+        except:
+            _release(zkaddr, path)
+            raise
+        client = _client(addresses, client, zkaddr, path, selection, options,
+                         stats)
+        if wait:
+            _wait_connected(client, self.config.wait_timeout)
+        return client
+
+class OpenError(Exception):
+    """Storages couldn't be opened.
+
+    The errors attribute has a list of (section name, exception) pairs.
+    """
+
+    def __init__(self, errors):
+        Exception.__init__(self, errors)
+        self.errors = errors
+
+    def __str__(self):
+        return "Couldn't open storages: " + ', '.join(
+            "%s (%s: %s)" % (name, v.__class__.__name__, v)
+            for (name, v) in self.errors)
+
+def open_storages(database_factories, threads=4):
+    """Open the zkzeoclient storages of database configurations at once.
+
+    The storages are opened using up to the given number of threads,
+    so that the time taken is that of the slowest storage, rather
+    than the sum.  Database factories then use the opened storages.
+
+    If any storages can't be opened, the storages that were opened are
+    closed and an OpenError is raised.
+    """
+    factories = [factory.config.storage for factory in database_factories
+                 if isinstance(factory.config.storage, ZConfig)]
+    todo = factories[::-1]
+    failed = {} # {factory -> exception}
+
+    def zkzeo_open_thread():
+        while 1:
+            try:
+                factory = todo.pop()
+            except IndexError:
+                return
+            try:
+                factory.opened.append(factory.open())
+            except Exception as v:
+                logger.exception("Couldn't open %s", factory.name)
+                failed[factory] = v
+
+    workers = [zc.thread.Thread(zkzeo_open_thread)
+               for i in range(min(threads, len(factories)))]
+    for thread in workers:
+        thread.join()
+
+    if failed:
+        _close_opened(factories)
+        raise OpenError([(factory.name, failed[factory])
+                         for factory in factories if factory in failed])
+
+def _close_opened(factories):
+    for factory in factories:
+        while factory.opened:
+            factory.opened.pop().close()
+
+def _lazy(factory):
+    storage = factory.config.storage
+    return isinstance(storage, ZConfig) and storage.config.lazy
+
+def databaseFromConfig(database_factories, threads=4):
+    """Open databases, opening zkzeoclient storages at once.
 
-        client = ZODB.config.ZEOClient(self.config).open()
-        return _client(addresses, client, zkaddr, path)
+    This is like ZODB.config.databaseFromConfig, except that
+    zkzeoclient storages are opened in parallel using open_storages,
+    and databases with lazy zkzeoclient storages are LazyDBs.
+    """
+    open_storages([factory for factory in database_factories
+                   if not _lazy(factory)], threads)
+    databases = {}
+    first = None
+    try:
+        for factory in database_factories:
+            if _lazy(factory):
+                storage = factory.config.storage
+                storage.deferred = True
+                db = LazyDB(storage.config.zookeeper, storage.path(),
+                            lambda factory=factory: factory.open(databases),
+                            factory.config.database_name or factory.name or '',
+                            databases)
+            else:
+                db = factory.open(databases)
+            if first is None:
+                first = db
+    except:
+        for db in databases.values():
+            db.close()
+        _close_opened(factory.config.storage
+                      for factory in database_factories
+                      if isinstance(factory.config.storage, ZConfig))
+        raise
+    return first
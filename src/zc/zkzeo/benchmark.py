@@ -0,0 +1,366 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""%prog [options]
+
+Benchmark ZooKeeper-mediated server discovery, failover and startup.
+
+The benchmarks run in process, against the ZooKeeper emulation in
+zc.zk.testing and ZEO servers run in threads, so they don't need
+ZooKeeper or ZEO servers.  (As with the tests, set
+TEST_ZOOKEEPER_CONNECTION to use a real ZooKeeper server.)
+
+Results are output as JSON.  Use -C to compare them with the results
+of an earlier run.
+"""
+import json
+import optparse
+import os
+import platform
+import sys
+import threading
+import time
+import zc.thread
+import zc.zk
+import zc.zkzeo
+import zc.zkzeo._client
+import zc.zkzeo.runzeo
+
+zkaddr = 'zookeeper.example.com:2181'
+
+def summary(samples):
+    """Summarize a list of measurements
+    """
+    samples = sorted(samples)
+    n = len(samples)
+    return dict(
+        count=n,
+        min=samples[0],
+        median=samples[n // 2],
+        p90=samples[min(n - 1, int(n * .9))],
+        mean=sum(samples) / n,
+        max=samples[-1],
+        )
+
+class Environment:
+    """ZooKeeper emulation and a scratch directory for servers
+    """
+
+    def __init__(self):
+        from zope.testing import setupstack
+        import zc.zk.testing
+
+        self.setupstack = setupstack
+        self.zk_testing = zc.zk.testing
+        setupstack.setUpDirectory(self)
+        zc.zk.testing.setUp(self, tree='/benchmark\n')
+        self.zk = zc.zk.ZooKeeper(zkaddr)
+        self.paths = 0
+
+    def path(self, name):
+        # A fresh path, so runs don't see each other's registrations.
+        self.paths += 1
+        path = '/benchmark/%s-%s' % (name, self.paths)
+        self.zk.create(path, '', zc.zk.OPEN_ACL_UNSAFE)
+        return path
+
+    def server(self, path):
+        return zc.zkzeo.runzeo.test(path, None, zkaddr)
+
+    def close(self):
+        self.zk.close()
+        self.zk_testing.tearDown(self)
+        self.setupstack.tearDown(self)
+
+def first_address(env, repeat, **options):
+    """Time for _wait_addresses to return the first address
+
+    For ``registered``, a server is registered before we wait.  For
+    ``registering``, the server is registered while we wait, and we
+    time from the registration.
+    """
+    registered = []
+    registering = []
+    for i in range(repeat):
+        path = env.path('first-address')
+        env.zk.register_server(path, ('127.0.0.1', 9000 + i),
+                               acl=zc.zk.OPEN_ACL_UNSAFE)
+        start = time.time()
+        addresses = zc.zkzeo._client._acquire(zkaddr, path)
+        try:
+            zc.zkzeo._client._wait_addresses(
+                addresses, zc.zkzeo._client.parse_addr, zkaddr, path, True)
+            registered.append(time.time() - start)
+        finally:
+            zc.zkzeo._client._release(zkaddr, path)
+
+        path = env.path('first-address')
+        addresses = zc.zkzeo._client._acquire(zkaddr, path)
+        start = []
+
+        @zc.thread.Thread
+        def zkzeo_benchmark_register_thread():
+            time.sleep(.01)
+            start.append(time.time())
+            env.zk.register_server(path, ('127.0.0.1', 9000 + i),
+                                   acl=zc.zk.OPEN_ACL_UNSAFE)
+
+        try:
+            zc.zkzeo._client._wait_addresses(
+                addresses, zc.zkzeo._client.parse_addr, zkaddr, path, True)
+            registering.append(time.time() - start[0])
+        finally:
+            zkzeo_benchmark_register_thread.join()
+            zc.zkzeo._client._release(zkaddr, path)
+
+    return dict(registered=summary(registered),
+                registering=summary(registering))
+
+def failover(env, repeat, timeout=60, **options):
+    """Time from unregistering a client's server to reconnecting
+
+    Two servers are registered and a client connects to one of them.
+    We delete the server's ephemeral node and time how long it takes
+    the client to connect to the other server.
+    """
+    seconds = []
+    for i in range(repeat):
+        path = env.path('failover')
+        stops = [env.server(path), env.server(path)]
+        client = zc.zkzeo.client(zkaddr, path, max_disconnect_poll=1)
+        try:
+            stats = client.zookeeper_stats
+            old = stats.server
+            start = time.time()
+            env.zk.delete(path + '/' + old)
+            deadline = start + timeout
+            while stats.server in (None, old):
+                if time.time() > deadline:
+                    raise AssertionError("Client didn't fail over")
+                time.sleep(.001)
+            seconds.append(time.time() - start)
+        finally:
+            client.close()
+            for stop in stops:
+                stop()
+
+    return dict(seconds=summary(seconds))
+
+def concurrent_open(env, repeat, clients=10, **options):
+    """Time for clients to open at once
+
+    ``clients`` threads open clients of the same server at the same
+    time.  ``seconds`` summarizes the times individual clients took and
+    ``wall_seconds`` summarizes the times until all were open.
+    """
+    path = env.path('open')
+    stop = env.server(path)
+    seconds = []
+    wall = []
+    try:
+        for i in range(repeat):
+            opened = []
+            errors = []
+            go = threading.Event()
+
+            def zkzeo_benchmark_open_thread():
+                go.wait()
+                start = time.time()
+                try:
+                    client = zc.zkzeo.client(zkaddr, path,
+                                             max_disconnect_poll=1)
+                except Exception as v:
+                    errors.append(v)
+                else:
+                    opened.append((time.time() - start, client))
+
+            threads = [zc.thread.Thread(zkzeo_benchmark_open_thread)
+                       for c in range(clients)]
+            start = time.time()
+            go.set()
+            for thread in threads:
+                thread.join()
+            wall.append(time.time() - start)
+            for elapsed, client in opened:
+                seconds.append(elapsed)
+                client.close()
+            if errors:
+                raise errors[0]
+    finally:
+        stop()
+
+    return dict(clients=clients, seconds=summary(seconds),
+                wall_seconds=summary(wall))
+
+def idle_cpu(env, repeat, clients=10, duration=5.0, **options):
+    """CPU used by the process while clients are idle
+
+    The process's CPU percentage is sampled ``repeat`` times over
+    ``duration`` seconds, first with just a server and then with
+    ``clients`` clients connected to it and waiting.
+    """
+    path = env.path('idle')
+    stop = env.server(path)
+    opened = []
+
+    def sample():
+        samples = []
+        for i in range(repeat):
+            times = os.times()
+            start = time.time()
+            time.sleep(duration / repeat)
+            cpu = sum(os.times()[:2]) - sum(times[:2])
+            samples.append(100.0 * cpu / (time.time() - start))
+        return samples
+
+    try:
+        baseline = sample()
+        for i in range(clients):
+            opened.append(zc.zkzeo.client(zkaddr, path,
+                                          max_disconnect_poll=1))
+        loaded = sample()
+    finally:
+        for client in opened:
+            client.close()
+        stop()
+
+    return dict(clients=clients,
+                baseline_cpu_percent=summary(baseline),
+                cpu_percent=summary(loaded),
+                )
+
+benchmarks = (
+    ('first_address', first_address),
+    ('failover', failover),
+    ('concurrent_open', concurrent_open),
+    ('idle_cpu', idle_cpu),
+    )
+
+def run(names=None, repeat=10, **options):
+    """Run benchmarks and return their results
+    """
+    results = {}
+    env = Environment()
+    try:
+        for name, benchmark in benchmarks:
+            if names and name not in names:
+                continue
+            start = time.time()
+            result = benchmark(env, repeat, **options)
+            result['total_seconds'] = time.time() - start
+            results[name] = result
+    finally:
+        env.close()
+
+    import pkg_resources
+    return dict(
+        version=pkg_resources.get_distribution('zc.zkzeo').version,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        time=time.time(),
+        options=dict(options, repeat=repeat),
+        benchmarks=results,
+        )
+
+def medians(results, prefix=''):
+    """Return {name -> median} for the summaries in results
+    """
+    found = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            if 'median' in value:
+                found[prefix + name] = value['median']
+            else:
+                found.update(medians(value, prefix + name + '.'))
+    return found
+
+def compare(old, new, tolerance):
+    """Compare the medians of two runs
+
+    Lines describing the changes are returned, and whether any median
+    got worse by more than the tolerance, as a ratio.
+    """
+    old = medians(old['benchmarks'])
+    new = medians(new['benchmarks'])
+    lines = []
+    regressed = False
+    for name in sorted(new):
+        if name not in old:
+            continue
+        if old[name] > 0:
+            ratio = new[name] / old[name]
+        else:
+            ratio = 1.0 if new[name] <= 0 else float('inf')
+        flag = ''
+        if ratio > tolerance:
+            flag = ' REGRESSION'
+            regressed = True
+        lines.append('%s: %.6f -> %.6f (%.2fx)%s' % (
+            name, old[name], new[name], ratio, flag))
+    return lines, regressed
+
+def main(args=None):
+    parser = optparse.OptionParser(__doc__)
+    parser.add_option(
+        '-b', '--benchmark', action='append', dest='names',
+        help="Run the named benchmark, rather than all of them: %s"
+        % ', '.join(name for (name, _) in benchmarks),
+        )
+    parser.add_option(
+        '-n', '--repeat', type='int', default=10,
+        help="Number of times to repeat each measurement (default 10)",
+        )
+    parser.add_option(
+        '-c', '--clients', type='int', default=10,
+        help="Number of clients for the concurrent_open and idle_cpu"
+        " benchmarks (default 10)",
+        )
+    parser.add_option(
+        '-d', '--duration', type='float', default=5,
+        help="Seconds to measure idle clients for (default 5)",
+        )
+    parser.add_option(
+        '-o', '--output',
+        help="File to write results to, rather than standard output",
+        )
+    parser.add_option(
+        '-C', '--compare',
+        help="Results of an earlier run to compare with",
+        )
+    parser.add_option(
+        '-t', '--tolerance', type='float', default=1.5,
+        help="How many times slower a median can get before it's"
+        " reported as a regression (default 1.5)",
+        )
+    (options, args) = parser.parse_args(args)
+    if args:
+        parser.error("Unexpected arguments")
+
+    results = run(options.names, options.repeat,
+                  clients=options.clients, duration=options.duration)
+
+    data = json.dumps(results, sort_keys=True, indent=1)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+    if options.compare:
+        with open(options.compare) as f:
+            old = json.load(f)
+        lines, regressed = compare(old, results, options.tolerance)
+        for line in lines:
+            sys.stderr.write(line + '\n')
+        if regressed:
+            return 1
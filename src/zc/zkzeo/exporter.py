@@ -0,0 +1,344 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.0 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""%prog [options] zookeeper path
+
+Export metrics for the zkzeo servers registered under a ZooKeeper path
+for Prometheus.
+
+Where:
+
+  zookeeper
+    A ZooKeeper connection string
+
+  path
+    A ZooKeeper path.  Servers registered at or below the path are
+    monitored.
+"""
+import BaseHTTPServer
+import binascii
+import logging
+import optparse
+import re
+import threading
+import time
+import zc.thread
+import zc.zk
+import zc.zkzeo.status
+import ZODB.TimeStamp
+import zookeeper
+
+logger = logging.getLogger(__name__)
+
+NO_TRANSACTION = '0'*16
+
+gauges = (
+    ('connections', 'Number of connected clients'),
+    ('active_txns', 'Number of transactions in progress'),
+    ('waiting', 'Number of transactions waiting for the commit lock'),
+    ('verifying_clients', 'Number of clients verifying their caches'),
+    )
+
+counters = (
+    ('commits', 'Transactions committed'),
+    ('aborts', 'Transactions aborted'),
+    ('conflicts', 'Conflicts'),
+    ('conflicts_resolved', 'Conflicts resolved'),
+    ('loads', 'Object loads'),
+    ('stores', 'Object stores'),
+    )
+
+def is_address(name):
+    return re.match(r'(\[\S+\]|\S*):\d+$', name) is not None
+
+class Exporter:
+    """Monitor the servers registered under a ZooKeeper path
+
+    Registrations are tracked with ZooKeeper watches, and the servers
+    are polled every interval.  The metrics text is computed after
+    each poll, so serving it doesn't cost anything.  The tree under
+    the path is watched too, and is only searched for paths with
+    registered servers again when it changes.
+    """
+
+    def __init__(self, zookeeper, path, interval=15, timeout=5.0,
+                 threads=10):
+        self.zk = zc.zk.ZooKeeper(zookeeper)
+        self.path = path
+        self.interval = interval
+        self.timeout = timeout
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.registered = {} # {path -> set of server addresses}
+        self.watched = {} # {path -> zc.zk.Children}
+        self.walked = {} # {path -> zc.zk.Children} for discover
+        self.stale = threading.Event() # Set when the tree changes
+        self.stale.set()
+        self.churn = {} # {path -> [registrations, unregistrations]}
+        self.status = {} # {(path, addr) -> (seconds, ruok data or None)}
+        self.text = ''
+        self.stopped = threading.Event()
+
+    def discover(self, path=None):
+        """Look for paths with registered servers
+        """
+        if path is None:
+            path = self.path
+            self.stale.clear()
+        children = self.walked.get(path)
+        if children is None:
+            try:
+                children = self.walk(path)
+            except zookeeper.NoNodeException:
+                return
+        for name in sorted(children):
+            child = path.rstrip('/') + '/' + name
+            try:
+                ephemeral = self.zk.is_ephemeral(child)
+            except zookeeper.NoNodeException:
+                continue
+            if ephemeral:
+                if is_address(name) and path not in self.watched:
+                    self.watch(path)
+            else:
+                self.discover(child)
+
+    def walk(self, path):
+        # Watch the children of a node we search, so we know when to
+        # search again.
+        children = self.zk.children(path)
+        known = []
+
+        @children
+        def changed(children=None):
+            if children is None:
+                self.walked.pop(path, None) # It was deleted.
+                self.stale.set()
+                return
+            # Once we watch a path's registrations, we only care
+            # about its other children.
+            names = set(name for name in children if not is_address(name))
+            if known and (names != known[0] or (
+                path not in self.watched and len(names) < len(children))):
+                self.stale.set()
+            known[:] = [names]
+
+        self.walked[path] = children
+        return children
+
+    def watch(self, path):
+        children = self.zk.children(path)
+
+        @children
+        def changed(addresses):
+            # Servers listening on all interfaces register several
+            # addresses.  We count and poll each server once.
+            addresses = set(
+                addrs[0] for addrs in zc.zkzeo.status.servers(
+                    self.zk, path,
+                    [name for name in addresses if is_address(name)]))
+            with self.lock:
+                old = self.registered.get(path)
+                self.registered[path] = addresses
+                if old is None:
+                    self.churn[path] = [0, 0]
+                else:
+                    churn = self.churn[path]
+                    churn[0] += len(addresses - old)
+                    churn[1] += len(old - addresses)
+
+        self.watched[path] = children
+
+    def poll(self):
+        """Get the status of all of the registered servers
+        """
+        with self.lock:
+            todo = sorted((path, addr)
+                          for (path, addresses) in self.registered.items()
+                          for addr in addresses)
+        status = {}
+
+        def zkzeo_exporter_poll_thread():
+            while 1:
+                try:
+                    path, addr = todo.pop()
+                except IndexError:
+                    return
+                start = time.time()
+                try:
+                    data = zc.zkzeo.status.ruok(addr, self.timeout)
+                except Exception:
+                    logger.warning("Couldn't get status from %s", addr,
+                                   exc_info=True)
+                    data = None
+                status[path, addr] = time.time() - start, data
+
+        threads = [zc.thread.Thread(zkzeo_exporter_poll_thread)
+                   for i in range(max(1, min(self.threads, len(todo))))]
+        for thread in threads:
+            thread.join()
+
+        self.status = status
+        self.text = self.metrics()
+
+    def metrics(self):
+        """Return the metrics in the Prometheus text format
+        """
+        now = time.time()
+        lines = []
+
+        def metric(name, type_, help, samples):
+            lines.append('# HELP zkzeo_%s %s' % (name, help))
+            lines.append('# TYPE zkzeo_%s %s' % (name, type_))
+            for labels, value in samples:
+                lines.append('zkzeo_%s{%s} %s' % (
+                    name,
+                    ','.join('%s="%s"' % (label, _escape(labels[label]))
+                             for label in sorted(labels)),
+                    _number(value)))
+
+        with self.lock:
+            registered = dict((path, len(addresses))
+                              for (path, addresses) in self.registered.items())
+            churn = dict((path, list(counts))
+                         for (path, counts) in self.churn.items())
+
+        paths = sorted(registered)
+        metric('servers', 'gauge', 'Number of registered servers',
+               [(dict(path=path), registered[path]) for path in paths])
+        metric('registrations_total', 'counter',
+               'Server registrations seen',
+               [(dict(path=path), churn[path][0]) for path in paths])
+        metric('unregistrations_total', 'counter',
+               'Server unregistrations seen',
+               [(dict(path=path), churn[path][1]) for path in paths])
+
+        servers = sorted(self.status.items())
+        metric('up', 'gauge', 'Whether the server answered',
+               [(dict(path=path, server=addr), int(data is not None))
+                for ((path, addr), (seconds, data)) in servers])
+        metric('response_seconds', 'gauge',
+               'Time taken for the server to answer',
+               [(dict(path=path, server=addr), seconds)
+                for ((path, addr), (seconds, data)) in servers
+                if data is not None])
+
+        storages = [(dict(path=path, server=addr, storage=storage_id), sdata)
+                    for ((path, addr), (seconds, data)) in servers
+                    if data
+                    for (storage_id, sdata) in sorted(data.items())]
+        for name, help in gauges:
+            metric(name, 'gauge', help,
+                   [(labels, sdata[name]) for (labels, sdata) in storages
+                    if name in sdata])
+        for name, help in counters:
+            metric(name + '_total', 'counter', help,
+                   [(labels, sdata[name]) for (labels, sdata) in storages
+                    if name in sdata])
+        metric('commit_lock_held_seconds', 'gauge',
+               'How long the commit lock has been held',
+               [(labels, max(now - sdata['lock_time'], 0)
+                 if sdata.get('lock_time') else 0)
+                for (labels, sdata) in storages])
+        metric('last_transaction_timestamp_seconds', 'gauge',
+               'The time of the last committed transaction',
+               [(labels, _tid_time(sdata['last-transaction']))
+                for (labels, sdata) in storages
+                if sdata.get('last-transaction', NO_TRANSACTION)
+                != NO_TRANSACTION])
+
+        return '\n'.join(lines) + '\n'
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.stale.is_set():
+                    self.discover()
+                self.poll()
+            except Exception:
+                logger.exception("Error collecting metrics")
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        @zc.thread.Thread
+        def zkzeo_exporter_thread():
+            self.run()
+        return zkzeo_exporter_thread
+
+    def stop(self):
+        self.stopped.set()
+        self.zk.close()
+
+    def serve(self, address):
+        """Create an HTTP server that serves the metrics
+        """
+        exporter = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                text = exporter.text
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(text)))
+                self.end_headers()
+                self.wfile.write(text)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return BaseHTTPServer.HTTPServer(address, Handler)
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"')
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def _tid_time(tid):
+    return ZODB.TimeStamp.TimeStamp(binascii.unhexlify(tid)).timeTime()
+
+def main(args=None):
+    parser = optparse.OptionParser(__doc__)
+    parser.add_option(
+        '-a', '--address', default=':9477',
+        help="Address to serve metrics on, as host:port (default :9477)",
+        )
+    parser.add_option(
+        '-i', '--interval', type='float', default=15,
+        help="Seconds between polls of the servers (default 15)",
+        )
+    parser.add_option(
+        '-t', '--timeout', type='float', default=5,
+        help="Seconds to wait for a server to answer (default 5)",
+        )
+    parser.add_option(
+        '-j', '--threads', type='int', default=10,
+        help="Number of servers to poll at once (default 10)",
+        )
+    (options, args) = parser.parse_args(args)
+    [zookeeper, path] = args
+
+    logging.basicConfig()
+    host, port = options.address.rsplit(':', 1)
+    exporter = Exporter(zookeeper, path, options.interval, options.timeout,
+                        options.threads)
+    exporter.start()
+    server = exporter.serve((host, int(port)))
+    try:
+        server.serve_forever()
+    finally:
+        exporter.stop()
@@ -13,6 +13,7 @@ from __future__ import print_function
 #
 ##############################################################################
 """%prog [options] zookeeper path
+       %prog -b [options] zookeeper [path ...]
 
 Where:
 
@@ -21,6 +22,10 @@ Where:
 
   path
     A ZooKeeper path at which to look up a ZEO server
+
+In batch mode (-b), any number of paths can be given, and more can be
+read from a file (-f).  The servers are checked concurrently and a
+line of JSON is output for each path.
 """
 import json
 import optparse
@@ -29,8 +34,12 @@ import re
 import socket
 import struct
 import sys
+import threading
 import time
+import urllib
+import zc.thread
 import zc.zk
+import zc.zkzeo.status
 import ZEO.nagios
 
 zc_monitor_help = """zc.monitor server address to use to look up a server
@@ -59,7 +68,7 @@ def connect(addr):
     fp = s.makefile()
     return fp, s
 
-def find_server(zookeeper, path, monitor_address):
+def find_server(zookeeper, path, monitor_address, zk=None):
     server = None
     if monitor_address:
         try:
@@ -82,19 +91,28 @@ def find_server(zookeeper, path, monitor_address):
                          (sorted(servers), monitor_address))
         server = servers[0]
 
-    zk = zc.zk.ZK(zookeeper)
-    children = zk.get_children(path)
-    zk.close()
+    if zk is None:
+        zk = zc.zk.ZK(zookeeper)
+        try:
+            found = zc.zkzeo.status.servers(zk, path, zk.get_children(path))
+        finally:
+            zk.close()
+    else:
+        found = zc.zkzeo.status.servers(zk, path, zk.get_children(path))
     if server:
-        host, port = server.split(':')
+        host, port = zc.zkzeo.status.parse_address(server)
         if host:
-            children = [c for c in children if c == server]
+            found = [[addr for addr in addrs if addr == server]
+                     for addrs in found]
         else:
-            children = [c for c in children if c.split(':')[1] == port]
+            found = [[addr for addr in addrs
+                      if zc.zkzeo.status.parse_address(addr)[1] == port]
+                     for addrs in found]
+        found = [addrs for addrs in found if addrs]
 
-    if len(children) != 1:
+    if len(found) != 1:
         return print("Couldn't find server in ZooKeeper")
-    addr = children[0]
+    addr = found[0][0]
     return addr
 
 def main(args=None):
@@ -116,7 +134,33 @@ def main(args=None):
         help="Time unit for rate metrics",
         )
     parser.add_option('-M', '--zc-monitor-address', help=zc_monitor_help)
+    parser.add_option(
+        '-b', '--batch', action="store_true",
+        help="Check many paths, outputting a line of JSON for each. "
+        "In batch mode, the status path is a directory.",
+        )
+    parser.add_option(
+        '-f', '--paths-file',
+        help="File with paths to check in batch mode, one per line",
+        )
+    parser.add_option(
+        '-j', '--threads', type='int', default=10,
+        help="Number of servers to check at once in batch mode",
+        )
     (options, args) = parser.parse_args(args)
+
+    if options.batch:
+        if not args:
+            parser.error("A ZooKeeper connection string is required")
+        zk, paths = args[0], args[1:]
+        if options.paths_file:
+            with open(options.paths_file) as f:
+                paths.extend(line.strip() for line in f
+                             if line.strip() and not line.startswith('#'))
+        return batch(zk, paths, options)
+
+    if len(args) != 2:
+        parser.error("A ZooKeeper connection string and path are required")
     [zk, path] = args
 
     addr = find_server(zk, path, options.zc_monitor_address)
@@ -125,3 +169,91 @@ def main(args=None):
 
     return ZEO.nagios.check(
         addr, options.output_metrics, options.status_path, options.time_units)
+
+class ThreadOutput:
+    """Standard output that can be captured separately for each thread
+    """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def write(self, data):
+        captured = getattr(self.local, 'captured', None)
+        if captured is None:
+            self.stdout.write(data)
+        else:
+            captured.append(data)
+
+    def flush(self):
+        if getattr(self.local, 'captured', None) is None:
+            self.stdout.flush()
+
+    def capture(self, func, *args):
+        """Call func, returning its result and output
+        """
+        self.local.captured = captured = []
+        try:
+            result = func(*args)
+        finally:
+            self.local.captured = None
+        return result, ''.join(captured).strip()
+
+def check_path(zookeeper, zk, path, options):
+    addr = None
+    try:
+        addr = find_server(zookeeper, path, options.zc_monitor_address, zk)
+        if not addr:
+            return addr, 2
+
+        status_path = options.status_path
+        if status_path:
+            status_path = os.path.join(status_path, urllib.quote(path, ''))
+        status = ZEO.nagios.check(
+            addr, options.output_metrics, status_path, options.time_units)
+    except Exception as err:
+        print("%s: %s" % (err.__class__.__name__, err))
+        status = 2
+    return addr, status or 0
+
+def batch(zookeeper, paths, options):
+    """Check the servers at many paths, using a single ZooKeeper session
+
+    A line of JSON is output for each path, in the order given, with
+    the path, server address, status and (Nagios) output.  The
+    highest status is returned.
+    """
+    if options.status_path and not os.path.exists(options.status_path):
+        os.mkdir(options.status_path)
+
+    zk = zc.zk.ZK(zookeeper)
+    results = {}
+    todo = list(reversed(paths))
+    stdout = sys.stdout
+    sys.stdout = output = ThreadOutput(stdout)
+    try:
+        def zkzeo_nagios_thread():
+            while 1:
+                try:
+                    path = todo.pop()
+                except IndexError:
+                    return
+                results[path] = output.capture(
+                    check_path, zookeeper, zk, path, options)
+
+        threads = [zc.thread.Thread(zkzeo_nagios_thread)
+                   for i in range(max(1, min(options.threads, len(paths))))]
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.stdout = stdout
+        zk.close()
+
+    status = 0
+    for path in paths:
+        (addr, path_status), text = results[path]
+        print(json.dumps(dict(path=path, address=addr, status=path_status,
+                              output=text),
+                         sort_keys=True))
+        status = max(status, path_status)
+    return status
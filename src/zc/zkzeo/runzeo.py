@@ -1,12 +1,20 @@
 import asyncore
+import binascii
+import heapq
+import json
+import logging
 import os
 import select
+import socket
 import sys
 import threading
 import time
 import zc.thread
 import zc.zk
 import ZEO.runzeo
+import zookeeper
+
+logger = logging.getLogger(__name__)
 
 class Options(ZEO.runzeo.ZEOOptions):
 
@@ -23,12 +31,93 @@ class Options(ZEO.runzeo.ZEOOptions):
         self.add('zkpath', 'zookeeper.path')
         self.add('zookeeper_session_timeout', 'zookeeper.session_timeout')
         self.add('monitor_server', 'zookeeper.monitor_server')
+        self.add('metrics_interval', 'zookeeper.metrics_interval')
+        self.add('metrics_path', 'zookeeper.metrics_path')
+        self.add('hot_objects', 'zookeeper.hot_objects')
+        self.add('drain_grace', 'zookeeper.drain_grace')
+        self.add('weight', 'zookeeper.weight')
+        self.add('zone', 'zookeeper.zone')
+        self.add('rack', 'zookeeper.rack')
+        self.add('unix_socket', 'zookeeper.unix_socket')
+
+class HotObjects:
+    """Track the most frequently loaded objects of a storage.
+
+    Loads are recorded in a fixed-size buffer, so recording a load is
+    just a list append.  Full buffers are set aside and folded, by
+    calling fold, outside of the server's asyncore thread, into a
+    summary of at most size objects.  An object that's new to a full
+    summary starts with the largest count dropped so far, so counts
+    are upper bounds, off by at most error.
+    """
+
+    def __init__(self, size, buffer_size=1000):
+        self.size = size
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.full = [] # Full buffers, not folded yet
+        self.counts = {} # {oid -> count}
+        self.error = 0
+        self.lock = threading.Lock() # Guards the buffers
+        self.folding = threading.Lock() # Guards the summary
+
+    def record(self, oid):
+        with self.lock:
+            buffer = self.buffer
+            buffer.append(oid)
+            if len(buffer) >= self.buffer_size:
+                self.full.append(buffer)
+                self.buffer = []
+
+    def fold(self):
+        """Fold full buffers into the summary
+        """
+        with self.folding:
+            with self.lock:
+                full, self.full = self.full, []
+            counts, error = self.counts, self.error
+            for oids in full:
+                counts, error = self._fold(counts, error, oids)
+            self.counts, self.error = counts, error
+
+    def _fold(self, counts, error, oids):
+        for oid in oids:
+            counts[oid] = counts.get(oid, error) + 1
+        if len(counts) > self.size:
+            items = sorted(counts.items(), key=_count, reverse=True)
+            error = max(error, items[self.size][1])
+            counts = dict(items[:self.size])
+        return counts, error
+
+    def top(self, count=None):
+        """Return the most loaded oids and their counts, most loaded first
+        """
+        with self.folding:
+            with self.lock:
+                pending = self.full + [self.buffer[:]]
+            counts, error = dict(self.counts), self.error
+        for oids in pending:
+            counts, error = self._fold(counts, error, oids)
+        return heapq.nlargest(count or self.size, counts.items(),
+                              key=_count), error
+
+def _count(item):
+    return item[1]
 
 class ZKServer(ZEO.runzeo.ZEOServer):
 
-    __zk = __testing = __using_dynamic_port = None
+    __zk = __testing = __using_dynamic_port = __metrics_thread = None
+    __metrics_stopped = __hot_objects_thread = __hot_objects_stopped = None
+    __metrics = __metrics_node = __last_metrics = __draining = None
+    hot_objects = None # {storage_id -> HotObjects}
+    hot_objects_fold_interval = 1.0 # Seconds between folding loads
+
     def create_server(self):
         ZEO.runzeo.ZEOServer.create_server(self)
+        if self.options.hot_objects:
+            self.__track_hot_objects()
+        if self.options.unix_socket:
+            self.__listen_on_unix_socket()
         if self.__testing is not None:
             # Make the loop dies quickly when we close the storage
             # XXX should find a way to do this wo monkey patching. :/
@@ -41,7 +130,18 @@ class ZKServer(ZEO.runzeo.ZEOServer):
                 self.server.dispatcher.socket.getsockname()[1])
         def register():
 
-            props = {}
+            # With our pid, which zc.zk adds, our host name tells
+            # clients which registrations are ours.
+            props = dict(hostname=socket.gethostname())
+            for name in 'weight', 'zone', 'rack':
+                value = getattr(self.options, name)
+                if value is not None:
+                    props[name] = value
+
+            if self.options.unix_socket:
+                # Clients on this host can use our Unix socket.
+                props['unix_socket'] = self.options.unix_socket
+
             if self.options.monitor_server:
                 global zc
                 import zc.monitor, zope.configuration.xmlconfig
@@ -52,11 +152,42 @@ class ZKServer(ZEO.runzeo.ZEOServer):
                 if isinstance(maddr, tuple) and maddr[1] is None:
                     maddr = maddr[0], 0
 
+                if self.hot_objects is not None:
+                    zc.monitor.register(self.__hot_objects_command,
+                                        'hot_objects')
+                zc.monitor.register(self.__drain_command, 'drain')
+
                 maddr = zc.monitor.start(maddr)
                 if isinstance(maddr, tuple):
                     props['monitor'] = "%s:%s" % maddr
+                if self.hot_objects is not None:
+                    # Tell people where to find our hot objects.
+                    props['hot_objects'] = 'hot_objects'
+
+            if self.options.metrics_interval:
+                # Our registration is read-only, so we publish metrics
+                # on a separate node that it names.
+                props['metrics'] = self.__create_metrics_node()
+
+            host, port = addr
+            if ':' in host:
+                name = '[%s]:%s' % addr # IPv6
+            else:
+                name = '%s:%s' % addr
+            self.__zk.register_server(self.options.zkpath, name, **props)
+
+            if not host:
+                # zc.zk registered our IPv4 addresses.
+                path = self.__zk.resolve(self.options.zkpath).rstrip('/')
+                data = zc.zk.encode(dict(props, pid=os.getpid()))
+                for name in self.__ipv6_addresses(port):
+                    self.__zk.create(path + '/' + name, data,
+                                     zc.zk.READ_ACL_UNSAFE,
+                                     zookeeper.EPHEMERAL)
+
+            if self.options.metrics_interval:
+                self.__start_publishing_metrics()
 
-            self.__zk.register_server(self.options.zkpath, addr[:2], **props)
             if self.__testing is not None:
                 self.__testing()
 
@@ -77,9 +208,230 @@ class ZKServer(ZEO.runzeo.ZEOServer):
                 )
             register()
 
+    def __ipv6_addresses(self, port):
+        # If we listen on all IPv6 interfaces, as well as IPv4 ones,
+        # return our global IPv6 addresses.
+        if self.server.dispatcher.socket.family != socket.AF_INET6:
+            return []
+        try:
+            import netifaces
+        except ImportError:
+            return []
+
+        addrs = set()
+        for iface in netifaces.interfaces():
+            for info in netifaces.ifaddresses(iface).get(
+                netifaces.AF_INET6, ()):
+                addr = info.get('addr', '')
+                if addr and addr != '::1' and not addr.startswith('fe80:'):
+                    addrs.add('[%s]:%s' % (addr, port))
+        return sorted(addrs)
+
+    def __listen_on_unix_socket(self):
+        # Accept connections on a Unix socket, as well as on our
+        # address.  StorageServer only knows about its own dispatcher,
+        # so we close ours when it's closed.
+        path = self.options.unix_socket = os.path.abspath(
+            self.options.unix_socket)
+        if os.path.exists(path):
+            if self.can_connect(socket.AF_UNIX, path):
+                self.options.usage("unix-socket %s already in use" % path)
+            os.unlink(path)
+        server = self.server
+        dispatcher = server.DispatcherClass(
+            path, factory=server.new_connection, map=server.socket_map)
+        close = server.close
+        def close_server(*args, **kw):
+            dispatcher.close()
+            return close(*args, **kw)
+        server.close = close_server
+
+    def __track_hot_objects(self):
+        hot_objects = self.hot_objects = dict(
+            (storage_id, HotObjects(self.options.hot_objects))
+            for storage_id in self.server.storages)
+
+        base = self.server.ZEOStorageClass
+        class ZEOStorage(base):
+
+            def loadEx(self, oid):
+                hot_objects[self.storage_id].record(oid)
+                return base.loadEx(self, oid)
+
+            def loadBefore(self, oid, tid):
+                hot_objects[self.storage_id].record(oid)
+                return base.loadBefore(self, oid, tid)
+
+        self.server.ZEOStorageClass = ZEOStorage
+
+        # Loads are recorded in the asyncore thread, so we fold them
+        # into the summaries in our own.
+        stopped = self.__hot_objects_stopped = threading.Event()
+
+        @zc.thread.Thread
+        def zookeeper_hot_objects_thread():
+            while not stopped.is_set():
+                stopped.wait(self.hot_objects_fold_interval)
+                for tracked in hot_objects.values():
+                    try:
+                        tracked.fold()
+                    except Exception:
+                        logger.exception("Couldn't fold hot objects")
+
+        self.__hot_objects_thread = zookeeper_hot_objects_thread
+
+    def __hot_objects_command(self, connection, count=None):
+        """Show the most loaded objects for each storage
+
+        The output is a JSON object mapping storage names to objects
+        with error and objects items.  Objects are oids and load
+        counts, most loaded first.
+        """
+        result = {}
+        for storage_id, hot_objects in self.hot_objects.items():
+            top, error = hot_objects.top(count and int(count))
+            result[storage_id] = dict(
+                error=error,
+                objects=[[binascii.hexlify(oid), n] for (oid, n) in top],
+                )
+        connection.write(json.dumps(result, sort_keys=True) + '\n')
+
+    def drain(self, grace=None):
+        """Unregister, and shut down once clients have gone, or after grace
+
+        Clients using ZooKeeper move to other servers when we
+        unregister.  Grace defaults to the drain-grace option.
+        """
+        if self.__draining is not None:
+            return
+        if grace is None:
+            grace = self.options.drain_grace or 0
+        self.__draining = threading.Event()
+        logger.info("Draining, for up to %s seconds", grace)
+        if self.__metrics_stopped is not None:
+            self.__metrics_stopped.set()
+        if self.__zk is not None:
+            for path in list(self.__zk.ephemeral):
+                if path == self.__metrics_node:
+                    continue # It goes away with our session.
+                try:
+                    self.__zk.delete(path)
+                except zookeeper.NoNodeException:
+                    pass
+
+        @zc.thread.Thread
+        def zookeeper_drain_thread():
+            deadline = time.time() + grace
+            while self.__connections() and time.time() < deadline:
+                self.__draining.wait(.1)
+            logger.info("Drained, with %s clients remaining",
+                        self.__connections())
+            self.server.close()
+
+    def __connections(self):
+        return sum(len(connections)
+                   for connections in self.server.connections.values())
+
+    def __drain_command(self, connection, grace=None):
+        """Unregister the server and shut it down when clients have left
+
+        An optional maximum number of seconds to wait can be given.
+        """
+        self.drain(grace and float(grace))
+        connection.write("Draining\n")
+
+    def handle_sigterm(self):
+        if self.options.drain_grace and self.__draining is None:
+            self.drain()
+        else:
+            ZEO.runzeo.ZEOServer.handle_sigterm(self)
+
+    def __create_metrics_node(self):
+        # Without credentials, the metrics node has to be writable by
+        # anyone, which is why it's separate from our read-only
+        # registrations.  Its parent doesn't allow deletes.
+        parent = self.options.metrics_path.rstrip('/')
+        self.__zk.create_recursive(
+            parent, '',
+            [zc.zk.world_permission(
+                zookeeper.PERM_READ | zookeeper.PERM_CREATE)])
+        self.__metrics = self.__get_metrics()
+        path = self.__metrics_node = '%s/%s-%s' % (
+            parent, socket.gethostname(), os.getpid())
+        self.__zk.create(
+            path, zc.zk.encode(self.__metrics),
+            [zc.zk.world_permission(
+                zookeeper.PERM_READ | zookeeper.PERM_WRITE)],
+            zookeeper.EPHEMERAL)
+        return path
+
+    def __publish(self, metrics):
+        self.__metrics = metrics
+        self.__zk.set(self.__metrics_node, zc.zk.encode(metrics))
+
+    def __get_metrics(self):
+        # Compute cheap load indicators.
+        server = self.server
+        metrics = dict(connections=0, active_txns=0, waiting=0, size=0)
+        commits = 0
+        last_transaction = ''
+        for storage_id, storage in server.storages.items():
+            status = server.server_status(storage_id)
+            for name in 'connections', 'active_txns', 'waiting':
+                metrics[name] += status[name]
+            commits += status['commits']
+            last_transaction = max(last_transaction,
+                                   status['last-transaction'])
+            metrics['size'] += storage.getSize()
+        metrics['last_transaction'] = last_transaction
+
+        now = time.time()
+        if self.__last_metrics is None:
+            metrics['commit_rate'] = 0.0
+        else:
+            last_commits, last_time = self.__last_metrics
+            metrics['commit_rate'] = round(
+                (commits - last_commits) / max(now - last_time, .001), 3)
+        self.__last_metrics = commits, now
+        return metrics
+
+    def __start_publishing_metrics(self):
+        # We publish at most once per interval, and only if something
+        # changed, so we don't load ZooKeeper.
+        stopped = self.__metrics_stopped = threading.Event()
+
+        @zc.thread.Thread
+        def zookeeper_metrics_thread():
+            while 1:
+                stopped.wait(self.options.metrics_interval)
+                if stopped.is_set():
+                    break
+                try:
+                    metrics = self.__get_metrics()
+                    if metrics != self.__metrics:
+                        self.__publish(metrics)
+                except Exception:
+                    logger.exception("Couldn't publish metrics")
+
+        self.__metrics_thread = zookeeper_metrics_thread
+
     def clear_socket(self):
+        # Stop our threads before closing ZooKeeper, which the metrics
+        # thread uses.
+        for stopped, thread in (
+            (self.__metrics_stopped, self.__metrics_thread),
+            (self.__hot_objects_stopped, self.__hot_objects_thread),
+            ):
+            if stopped is not None:
+                stopped.set()
+                thread.join(9)
         if self.__zk is not None:
             self.__zk.close()
+        if self.options.unix_socket:
+            try:
+                os.unlink(self.options.unix_socket)
+            except os.error:
+                pass
         ZEO.runzeo.ZEOServer.clear_socket(self)
 
     def check_socket(self):
@@ -0,0 +1,80 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.0 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Find registered ZEO servers and ask them for their status
+"""
+import json
+import re
+import socket
+import struct
+import zookeeper
+
+def parse_address(addr):
+    """Split a registered address into a host and an integer port
+
+    IPv6 hosts are registered in brackets.
+    """
+    m = re.match(r'\[(\S+)\]:(\d+)$', addr)
+    if m is None:
+        m = re.match(r'(\S*):(\d+)$', addr)
+    return m.group(1), int(m.group(2))
+
+def servers(zk, path, addresses):
+    """Group the addresses registered at a path by server
+
+    Servers listening on all interfaces register an address for each,
+    with the same hostname and pid properties.  A list of lists of
+    addresses is returned, with a list for each server, with IPv4
+    addresses first.
+    """
+    groups = {}
+    for addr in addresses:
+        try:
+            properties = zk.get_properties(path.rstrip('/') + '/' + addr)
+        except zookeeper.NoNodeException:
+            continue # It went away
+        hostname, pid = properties.get('hostname'), properties.get('pid')
+        key = (hostname, pid) if (hostname and pid) else addr
+        groups.setdefault(key, []).append(addr)
+    return sorted(sorted(addrs, key=lambda addr: (addr.startswith('['), addr))
+                  for addrs in groups.values())
+
+def ruok(addr, timeout=5.0):
+    """Get the status of a ZEO server's storages
+    """
+    host, port = parse_address(addr)
+    if ':' in host:
+        addr = host, port
+        s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    else:
+        addr = host or 'localhost', port
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    s.settimeout(timeout)
+    try:
+        s.connect(addr)
+        s.sendall(b'\x00\x00\x00\x04ruok')
+        proto = _recv(s, struct.unpack(">I", _recv(s, 4))[0])
+        data = _recv(s, struct.unpack(">I", _recv(s, 4))[0])
+    finally:
+        s.close()
+    return json.loads(data.decode("ascii"))
+
+def _recv(s, size):
+    data = b''
+    while len(data) < size:
+        received = s.recv(size - len(data))
+        if not received:
+            raise socket.error("Connection closed")
+        data += received
+    return data
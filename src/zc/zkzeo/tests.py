@@ -19,7 +19,10 @@ import manuel.capture
 import manuel.doctest
 import manuel.testing
 import mock
+import os
 import re
+import socket
+import sys
 import time
 import ZEO.zrpc.connection
 import ZODB.config
@@ -27,9 +30,13 @@ import zc.monitor
 import zc.zk.monitor
 import zc.zk.testing
 import zc.zkzeo
+import zc.zkzeo._client
 import zc.zkzeo.runzeo
+import zc.zkzeo.status
+import zope.component
 import zope.testing.loggingsupport
 import zope.testing.renormalizing
+import zookeeper
 
 
 def client_exception_when_no_zookeeper_running():
@@ -174,88 +181,2360 @@ def client_start_with_empty_addresses():
     >>> t2.value.is_connected()
     True
 
+    The clients' threads log independently, so sort the records:
+
+    >>> for record in sorted(handler.records, key=lambda r: -r.levelno):
+    ...     print record.levelname, record.getMessage()
+    ... # doctest: +NORMALIZE_WHITESPACE
+    WARNING OK: Got addresses from <zookeeper.example.com:2181/databases/demo>
+    WARNING OK: Got addresses from <zookeeper.example.com:2181/databases/demo>
+    INFO Addresses from <zookeeper.example.com:2181/databases/demo>:
+      ['127.0.0.1:52814']
+    INFO Addresses from <zookeeper.example.com:2181/databases/demo>:
+      ['127.0.0.1:52814']
+
+    >>> handler.uninstall()
+
+    >>> t1.value.close()
+    >>> t2.value.close()
+    >>> _ = stop()
+    """
+
+def client_start_with_empty_addresses_and_no_wait():
+    """
+    >>> handler = zope.testing.loggingsupport.InstalledHandler('zc.zkzeo')
+
+    >>> c1 = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, wait=False)
+
+    >>> c2 = ZODB.config.storageFromString('''
+    ...     %import zc.zkzeo
+    ...     <zkzeoclient>
+    ...        zookeeper zookeeper.example.com:2181
+    ...        server /databases/demo
+    ...        max-disconnect-poll 1
+    ...        wait false
+    ...     </zkzeoclient>
+    ...     ''')
+
+    Wait a while:
+
+    >>> time.sleep(9)
+
+    At this point, since there aren't any addresses, so both clients are
+    disconnected:
+
+    >>> c1.is_connected(), c2.is_connected()
+    (False, False)
+
+    >>> print handler
+    zc.zkzeo WARNING
+      No addresses from <zookeeper.example.com:2181/databases/demo>
+    zc.zkzeo WARNING
+      No addresses from <zookeeper.example.com:2181/databases/demo>
+
+    >>> handler.clear()
+
+    Now let's start a server:
+
+    >>> stop = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+
+    And the clients will connect:
+
+    >>> wait(c1.is_connected)
+    >>> wait(c2.is_connected)
+
+    >>> print handler # doctest: +NORMALIZE_WHITESPACE
+    zc.zkzeo WARNING
+      OK: Addresses from <zookeeper.example.com:2181/databases/demo>
+    zc.zkzeo INFO
+      Addresses from <zookeeper.example.com:2181/databases/demo>:
+      ['127.0.0.1:52814']
+    zc.zkzeo WARNING
+      OK: Addresses from <zookeeper.example.com:2181/databases/demo>
+    zc.zkzeo INFO
+      Addresses from <zookeeper.example.com:2181/databases/demo>:
+      ['127.0.0.1:52814']
+
+    >>> handler.uninstall()
+
+    >>> c1.close()
+    >>> c2.close()
+    >>> _ = stop()
+    """
+
+def client_start_with_empty_addresses_and_wait_timeout():
+    """
+    >>> handler = zope.testing.loggingsupport.InstalledHandler('zc.zkzeo')
+
+    >>> c1 = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, wait_timeout=1)
+
+    >>> c2 = ZODB.config.storageFromString('''
+    ...     %import zc.zkzeo
+    ...     <zkzeoclient>
+    ...        zookeeper zookeeper.example.com:2181
+    ...        server /databases/demo
+    ...        max-disconnect-poll 1
+    ...        wait-timeout 1
+    ...     </zkzeoclient>
+    ...     ''')
+
+    We gave up waiting and the clients are disconnected:
+
+    >>> c1.is_connected(), c2.is_connected()
+    (False, False)
+
+    >>> print handler # doctest: +NORMALIZE_WHITESPACE
+    zc.zkzeo WARNING
+      No addresses from <zookeeper.example.com:2181/databases/demo>
+    zc.zkzeo WARNING
+      Timed out waiting for addresses from
+      <zookeeper.example.com:2181/databases/demo>
+    zc.zkzeo WARNING
+      No addresses from <zookeeper.example.com:2181/databases/demo>
+    zc.zkzeo WARNING
+      No addresses from <zookeeper.example.com:2181/databases/demo>
+    zc.zkzeo WARNING
+      Timed out waiting for addresses from
+      <zookeeper.example.com:2181/databases/demo>
+    zc.zkzeo WARNING
+      No addresses from <zookeeper.example.com:2181/databases/demo>
+
+    >>> handler.clear()
+
+    When a server starts, the clients connect:
+
+    >>> stop = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+
+    >>> wait(c1.is_connected)
+    >>> wait(c2.is_connected)
+
+    >>> handler.uninstall()
+    >>> c1.close()
+    >>> c2.close()
+    >>> _ = stop()
+    """
+
+def waiting_for_addresses_without_blocking():
+    """
+    zc.zkzeo._client._when_addresses calls a function once there are
+    addresses, without blocking:
+
+    >>> addresses = zc.zkzeo._client._acquire(
+    ...     'zookeeper.example.com:2181', '/databases/demo')
+
+    >>> def got(addresses):
+    ...     print 'got', sorted(addresses)
+    >>> zc.zkzeo._client._when_addresses(addresses, got)
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.register_server('/databases/demo', 'a:1')
+    got ['a:1']
+
+    The function is called only once:
+
+    >>> zk.register_server('/databases/demo', 'b:1')
+
+    If there are already addresses, it's called right away:
+
+    >>> zc.zkzeo._client._when_addresses(addresses, got)
+    got ['a:1', 'b:1']
+
+    and the watch doesn't hang around:
+
+    >>> addresses.callbacks
+    []
+
+    >>> zk.close()
+    >>> zc.zkzeo._client._release(
+    ...     'zookeeper.example.com:2181', '/databases/demo')
+    """
+
+def clients_share_zookeeper_sessions():
+    """Clients of the same ZooKeeper ensemble share a session and clients
+    of the same path share a watch.
+
+    >>> stop = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+
+    >>> c1 = zc.zkzeo.client('zookeeper.example.com:2181',
+    ...                      '/databases/demo', max_disconnect_poll=1)
+    >>> c2 = ZODB.config.storageFromString('''
+    ...     %import zc.zkzeo
+    ...     <zkzeoclient>
+    ...        zookeeper zookeeper.example.com:2181
+    ...        server /databases/demo
+    ...        max-disconnect-poll 1
+    ...     </zkzeoclient>
+    ...     ''')
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> _ = zk.create('/databases/other', '', zc.zk.OPEN_ACL_UNSAFE)
+    >>> zk.close()
+    >>> c3 = zc.zkzeo.client('zookeeper.example.com:2181', '/databases/other',
+    ...                      wait=False, max_disconnect_poll=1)
+
+    >>> c1.zookeeper_addresses is c2.zookeeper_addresses
+    True
+    >>> [session] = zc.zkzeo._client._sessions.values()
+    >>> sorted(session.refs.items())
+    [('/databases/demo', 2), ('/databases/other', 1)]
+
+    The session is closed when the last client using it is closed:
+
+    >>> c1.close()
+    >>> c1.close()
+    >>> sorted(session.refs.items())
+    [('/databases/demo', 1), ('/databases/other', 1)]
+    >>> c3.close()
+    >>> sorted(session.refs.items())
+    [('/databases/demo', 1)]
+    >>> session.zk.handle is None
+    False
+
+    >>> c2.close()
+    >>> zc.zkzeo._client._sessions
+    {}
+    >>> session.zk.handle is None
+    True
+
+    Connecting to one ensemble doesn't hold up clients of others:
+
+    >>> import threading
+    >>> ZooKeeper = zc.zk.ZooKeeper
+    >>> connecting = threading.Event()
+    >>> timed_out = []
+    >>> def connect(zkaddr):
+    ...     if zkaddr == 'slow.example.com:2181':
+    ...         timed_out.append(not connecting.wait(5))
+    ...     return ZooKeeper('zookeeper.example.com:2181')
+    >>> with mock.patch('zc.zk.ZooKeeper', side_effect=connect):
+    ...     thread = threading.Thread(target=lambda :
+    ...         zc.zkzeo._client._acquire(
+    ...             'slow.example.com:2181', '/databases/demo'))
+    ...     thread.setDaemon(True)
+    ...     thread.start()
+    ...     wait(lambda : 'slow.example.com:2181' in
+    ...                   zc.zkzeo._client._sessions)
+    ...     _ = zc.zkzeo._client._acquire(
+    ...         'zookeeper.example.com:2181', '/databases/demo')
+    ...     connecting.set()
+    ...     thread.join(10)
+    >>> timed_out
+    [False]
+
+    >>> zc.zkzeo._client._release(
+    ...     'zookeeper.example.com:2181', '/databases/demo')
+    >>> zc.zkzeo._client._release('slow.example.com:2181', '/databases/demo')
+    >>> zc.zkzeo._client._sessions
+    {}
+
+    >>> _ = stop()
+    """
+
+def databases_below_a_path():
+    """databases opens the databases registered below a path on demand
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> _ = zk.create('/databases/other', '', zc.zk.OPEN_ACL_UNSAFE)
+    >>> stop_demo = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> stop_other = zc.zkzeo.runzeo.test(
+    ...     '/databases/other', None, 'zookeeper.example.com:2181')
+
+    >>> databases = zc.zkzeo.databases(
+    ...     'zookeeper.example.com:2181', '/databases', max_disconnect_poll=1)
+    >>> sorted(databases), len(databases), 'demo' in databases
+    (['demo', 'other'], 2, True)
+
+    Databases aren't opened until they're used.  Until then, there's
+    just the watch on the parent path:
+
+    >>> databases.opened()
+    []
+    >>> [session] = zc.zkzeo._client._sessions.values()
+    >>> sorted(session.refs)
+    ['/databases']
+
+    >>> demo = databases['demo']
+    >>> with demo.transaction() as conn:
+    ...     conn.root.x = 1
+    >>> databases['demo'] is demo
+    True
+    >>> databases.opened()
+    ['demo']
+    >>> sorted(session.refs)
+    ['/databases', '/databases/demo']
+
+    >>> databases['nope']
+    Traceback (most recent call last):
+    ...
+    KeyError: 'nope'
+    >>> databases.get('nope')
+
+    Databases added in ZooKeeper show up, and databases removed are
+    closed:
+
+    >>> _ = zk.create('/databases/new', '', zc.zk.OPEN_ACL_UNSAFE)
+    >>> sorted(databases)
+    ['demo', 'new', 'other']
+
+    >>> other = databases['other']
+    >>> databases.opened()
+    ['demo', 'other']
+    >>> [addr] = zk.get_children('/databases/other')
+    >>> _ = zk.delete('/databases/other/' + addr)
+    >>> _ = zk.delete('/databases/other')
+    >>> sorted(databases)
+    ['demo', 'new']
+    >>> databases.opened()
+    ['demo']
+    >>> sorted(session.refs)
+    ['/databases', '/databases/demo']
+    >>> _ = stop_other()
+
+    Opening a database that's waiting for its servers doesn't hold up
+    opening others:
+
+    >>> _ = zk.create('/databases/down', '', zc.zk.OPEN_ACL_UNSAFE)
+    >>> _ = zk.create('/databases/up', '', zc.zk.OPEN_ACL_UNSAFE)
+    >>> stop_up = zc.zkzeo.runzeo.test(
+    ...     '/databases/up', None, 'zookeeper.example.com:2181')
+
+    >>> import threading
+    >>> down = []
+    >>> thread = threading.Thread(
+    ...     target=lambda : down.append(databases['down']))
+    >>> thread.setDaemon(True)
+    >>> thread.start()
+    >>> wait(lambda : '/databases/down' in session.refs)
+    >>> databases['up'] is databases['up']
+    True
+    >>> databases.opened()
+    ['demo', 'up']
+
+    >>> stop_down = zc.zkzeo.runzeo.test(
+    ...     '/databases/down', None, 'zookeeper.example.com:2181')
+    >>> thread.join(10)
+    >>> databases['down'] is down[0]
+    True
+
+    Closing closes the opened databases and releases the watches:
+
+    >>> databases.close()
+    >>> zc.zkzeo._client._sessions
+    {}
+    >>> databases['demo']
+    Traceback (most recent call last):
+    ...
+    ValueError: Databases are closed
+
+    A factory can be given to open something other than databases,
+    such as storages:
+
+    >>> storages = zc.zkzeo.databases(
+    ...     'zookeeper.example.com:2181', '/databases', max_disconnect_poll=1,
+    ...     factory=zc.zkzeo.client)
+    >>> storages['demo'].is_connected()
+    True
+    >>> storages.close()
+
+    >>> zk.close()
+    >>> _ = stop_demo()
+    >>> _ = stop_up()
+    >>> _ = stop_down()
+    """
+
+def latency_selection():
+    """With latency selection, clients prefer the fastest server.
+
+    >>> stop1 = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> stop2 = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> def addr(stop):
+    ...     return '127.0.0.1:%s' % (
+    ...         stop.server.server.dispatcher.socket.getsockname()[1])
+    >>> addr1, addr2 = addr(stop1), addr(stop2)
+
+    Servers are probed by connecting to them:
+
+    >>> selection = zc.zkzeo._client.LatencySelection({})
+    >>> selection.probe(addr1) > 0
+    True
+    >>> import ZEO.tests.forker
+    >>> print selection.probe('127.0.0.1:%s' % ZEO.tests.forker.get_port())
+    None
+
+    We'll fake the probes:
+
+    >>> rtts = {addr1: .01, addr2: .002}
+    >>> probe = mock.patch('zc.zkzeo._client.LatencySelection.probe',
+    ...                    lambda self, addr: rtts[addr])
+    >>> _ = probe.start()
+
+    >>> c1 = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, selection='latency', probe_interval=.1)
+    >>> c2 = ZODB.config.storageFromString('''
+    ...     %import zc.zkzeo
+    ...     <zkzeoclient>
+    ...        zookeeper zookeeper.example.com:2181
+    ...        server /databases/demo
+    ...        max-disconnect-poll 1
+    ...        selection latency
+    ...     </zkzeoclient>
+    ...     ''')
+
+    The clients are only given the fastest server:
+
+    >>> def selected(client):
+    ...     return ['%s:%s' % addr for (_, addr) in client._rpc_mgr.addrlist]
+    >>> selected(c1) == selected(c2) == [addr2]
+    True
+    >>> c1.is_connected()
+    True
+
+    Servers are probed periodically.  If the times change, the
+    preferred server changes:
+
+    >>> rtts[addr2] = .05
+    >>> wait(lambda : selected(c1) == [addr1])
+
+    Unreachable servers are avoided:
+
+    >>> selection = c1.zookeeper_selection
+    >>> rtts[addr1] = None
+    >>> selection.measure([addr1, addr2])
+    >>> selection([addr1, addr2]) == [addr2, addr1]
+    True
+
+    Servers are probed at once, so slow servers don't add up:
+
+    >>> def slow_probe(self, addr):
+    ...     time.sleep(.5)
+    ...     return rtts[addr]
+    >>> with mock.patch('zc.zkzeo._client.LatencySelection.probe',
+    ...                 slow_probe):
+    ...     start = time.time()
+    ...     selection.measure([addr1, addr2])
+    ...     time.time() - start < .9
+    True
+    >>> selection([addr1, addr2]) == [addr2, addr1]
+    True
+
+    And servers we haven't measured yet come before unreachable
+    servers, but after servers we have measured:
+
+    >>> selection(['127.0.0.1:1', addr1, addr2]) == [
+    ...     addr2, '127.0.0.1:1', addr1]
+    True
+
+    >>> c1.close()
+    >>> c2.close()
+    >>> probe.stop()
+    >>> _ = stop1()
+    >>> _ = stop2()
+
+    Asking for a selection we don't know about is an error:
+
+    >>> zc.zkzeo.client('zookeeper.example.com:2181', '/databases/demo',
+    ...                 selection='fastest')
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown selection, 'fastest'
+    """
+
+def hash_and_random_selection():
+    """Hash selection uses rendezvous hashing on a client id.
+
+    >>> addrs = ['a:1', 'b:1', 'c:1', 'd:1']
+    >>> selection = zc.zkzeo._client.HashSelection(dict(client_id='app1'))
+    >>> ordered = selection(addrs)
+    >>> sorted(ordered) == addrs
+    True
+
+    The same id always gets the same order:
+
+    >>> zc.zkzeo._client.HashSelection(dict(client_id='app1'))(addrs
+    ...     ) == ordered
+    True
+
+    When servers are added or removed, clients only move if the server
+    they were using went away:
+
+    >>> [first, second] = ordered[:2]
+    >>> selection([a for a in addrs if a != second])[0] == first
+    True
+    >>> selection(addrs + ['e:1', 'f:1'])[0] in (first, 'e:1', 'f:1')
+    True
+    >>> selection([a for a in addrs if a != first])[0] == second
+    True
+
+    Different ids spread over the servers:
+
+    >>> len(set(zc.zkzeo._client.HashSelection(dict(client_id=str(i))
+    ...                                         )(addrs)[0]
+    ...         for i in range(100)))
+    4
+
+    If no id is given, the host name and process id are used:
+
+    >>> import os, socket
+    >>> zc.zkzeo._client.HashSelection({}).key == '%s:%s' % (
+    ...     socket.gethostname(), os.getpid())
+    True
+
+    Random selection is hash selection with a random id.  Each client
+    makes a random choice, but sticks with it:
+
+    >>> selection = zc.zkzeo._client.RandomSelection({})
+    >>> selection(addrs) == selection(list(reversed(addrs)))
+    True
+    >>> len(set(zc.zkzeo._client.RandomSelection({})(addrs)[0]
+    ...         for i in range(100)))
+    4
+    """
+
+def least_connections_selection():
+    """Least-connections selection uses load that servers publish.
+
+    We'll register some servers by hand:
+
+    >>> import ZEO.tests.forker
+    >>> addr1, addr2 = ['127.0.0.1:%s' % ZEO.tests.forker.get_port()
+    ...                 for i in range(2)]
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.register_server('/databases/demo', addr1,
+    ...                    acl=zc.zk.OPEN_ACL_UNSAFE, connections=3)
+    >>> zk.register_server('/databases/demo', addr2,
+    ...                    acl=zc.zk.OPEN_ACL_UNSAFE, connections=1)
+
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, selection='least-connections', wait=False)
+    >>> def selected(client):
+    ...     return ['%s:%s' % addr for (_, addr) in client._rpc_mgr.addrlist]
+    >>> selected(client) == [addr2]
+    True
+
+    When the load changes, so does the preferred server:
+
+    >>> zk.properties('/databases/demo/' + addr2).update(connections=5)
+    >>> selected(client) == [addr1]
+    True
+
+    Servers that don't publish their load are used last:
+
+    >>> zk.properties('/databases/demo/' + addr1).set(pid=1)
+    >>> selected(client) == [addr2]
+    True
+
+    Servers publishing metrics name the nodes they publish them on in
+    their registrations, and these are used:
+
+    >>> zk.create('/metrics', '', zc.zk.OPEN_ACL_UNSAFE)
+    '/metrics'
+    >>> zk.create('/metrics/server3', zc.zk.encode(dict(connections=0)),
+    ...           zc.zk.OPEN_ACL_UNSAFE, zookeeper.EPHEMERAL)
+    '/metrics/server3'
+    >>> addr3 = '127.0.0.1:%s' % ZEO.tests.forker.get_port()
+    >>> zk.register_server('/databases/demo', addr3,
+    ...                    metrics='/metrics/server3')
+    >>> selected(client) == [addr3]
+    True
+
+    >>> zk.properties('/metrics/server3').update(connections=9)
+    >>> selected(client) == [addr2]
+    True
+
+    >>> client.close()
+    >>> zk.close()
+    """
+
+def preferring_selections_fall_back():
+    """Clients with preferences fall back to other servers
+
+    ZEO is given just a selection's first choice, but if it can't
+    connect to it, it's given the rest.  Here, the preferred server
+    is registered, but isn't listening:
+
+    >>> import ZEO.tests.forker
+    >>> dead = '127.0.0.1:%s' % ZEO.tests.forker.get_port()
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.register_server('/databases/demo', dead, connections=0)
+    >>> stop = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> [live] = [addr for addr in zk.get_children('/databases/demo')
+    ...           if addr != dead]
+
+    >>> with mock.patch('zc.zkzeo._client._fallback_delay', .1):
+    ...     client = zc.zkzeo.client(
+    ...         'zookeeper.example.com:2181', '/databases/demo',
+    ...         max_disconnect_poll=1, selection='least-connections')
+    >>> client.zookeeper_stats.server == live
+    True
+    >>> [event['address'] for event in client.zookeeper_stats.events
+    ...  if event['name'] == 'fallback'] == [dead]
+    True
+
+    Once connected, ZEO is given just the first choice again, for when
+    it reconnects:
+
+    >>> wait(lambda : client.zookeeper_stats.addresses == [dead])
+
+    >>> client.close()
+    >>> _ = stop()
+
+    Servers listening on several interfaces register several
+    addresses.  Selections group them by the servers' host names and
+    process ids, so these servers aren't favored:
+
+    >>> _ = zk.delete('/databases/demo/' + dead)
+    >>> for addr in 'a1:1', 'a2:1', 'a3:1':
+    ...     zk.register_server('/databases/demo', addr, hostname='a')
+    >>> zk.register_server('/databases/demo', 'b1:1', hostname='b')
+
+    >>> addresses = zc.zkzeo._client._acquire(
+    ...     'zookeeper.example.com:2181', '/databases/demo')
+    >>> def first(client_id):
+    ...     selection = zc.zkzeo._client.HashSelection(
+    ...         dict(client_id=client_id), addresses)
+    ...     selection.prepare(list(addresses))
+    ...     try:
+    ...         return selection.select(list(addresses))
+    ...     finally:
+    ...         selection.stop()
+    >>> firsts = [first(str(i))[0] for i in range(200)]
+    >>> 70 < firsts.count('b1:1') < 130
+    True
+
+    A server's addresses are together, so ZEO falls back to a
+    server's other addresses first:
+
+    >>> [first(str(i)) for i in range(200)
+    ...  if first(str(i))[0] != 'b1:1'][0]
+    ['a1:1', 'a2:1', 'a3:1', 'b1:1']
+
+    >>> zc.zkzeo._client._release(
+    ...     'zookeeper.example.com:2181', '/databases/demo')
+    >>> zk.close()
+    """
+
+def weighted_selection():
+    """Weighted selection spreads clients by published weights and zones
+
+    Servers publish weights, zones and racks with options in their
+    ``zookeeper`` sections:
+
+    >>> stop = zc.zkzeo.runzeo.test('''
+    ...   <zeo>
+    ...      address 127.0.0.1
+    ...   </zeo>
+    ...
+    ...   <zookeeper>
+    ...      connection zookeeper.example.com:2181
+    ...      path /databases/demo
+    ...      weight 4
+    ...      zone us-east-1a
+    ...      rack r12
+    ...   </zookeeper>
+    ...   <mappingstorage>
+    ...   </mappingstorage>
+    ...   ''')
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> [addr] = zk.get_children('/databases/demo')
+    >>> properties = zk.get_properties('/databases/demo/' + addr)
+    >>> properties['weight'], properties['zone'], properties['rack']
+    (4.0, u'us-east-1a', u'r12')
+    >>> stop().exception
+
+    Clients are spread over servers in proportion to their weights:
+
+    >>> addrs = ['a:1', 'b:1', 'c:1']
+    >>> def selection(**options):
+    ...     selection = zc.zkzeo._client.WeightedSelection(options)
+    ...     selection.properties = {
+    ...         'a:1': dict(weight=3, zone='east'),
+    ...         'b:1': dict(weight=1, zone='east'),
+    ...         'c:1': dict(weight=4, zone='west'),
+    ...         }
+    ...     return selection
+    >>> counts = {}
+    >>> for i in range(1000):
+    ...     addr = selection(client_id=str(i))(addrs)[0]
+    ...     counts[addr] = counts.get(addr, 0) + 1
+    >>> 300 < counts['a:1'] < 450, 75 < counts['b:1'] < 175
+    (True, True)
+    >>> 425 < counts['c:1'] < 575
+    True
+
+    If the client has a zone, servers in the zone are used first,
+    still by weight:
+
+    >>> counts = {}
+    >>> for i in range(1000):
+    ...     ordered = selection(client_id=str(i), zone='east')(addrs)
+    ...     counts[ordered[0]] = counts.get(ordered[0], 0) + 1
+    ...     assert ordered[2] == 'c:1'
+    >>> sorted(counts)
+    ['a:1', 'b:1']
+    >>> 675 < counts['a:1'] < 825
+    True
+
+    If there aren't servers in the client's zone, other servers are
+    used:
+
+    >>> selection(client_id='1', zone='north')(addrs) == (
+    ...     selection(client_id='1')(addrs))
+    True
+
+    Servers without weights have a weight of 1.  Servers with weights
+    of 0 are used last:
+
+    >>> s = selection(client_id='1')
+    >>> s.properties['a:1'] = {}
+    >>> s.weight('a:1')
+    1.0
+    >>> s.properties['c:1'] = dict(weight=0)
+    >>> s(addrs)[-1]
+    'c:1'
+
+    As with hash selection, clients only move if the server they're
+    using goes away:
+
+    >>> moved = 0
+    >>> for i in range(100):
+    ...     s = selection(client_id=str(i))
+    ...     first = s(addrs)[0]
+    ...     if first != 'a:1' and s([a for a in addrs if a != 'a:1']
+    ...                            )[0] != first:
+    ...         moved += 1
+    >>> moved
+    0
+
+    Clients watch the registrations, so when weights change, so do
+    their preferences:
+
+    >>> import ZEO.tests.forker
+    >>> addr1, addr2 = ['127.0.0.1:%s' % ZEO.tests.forker.get_port()
+    ...                 for i in range(2)]
+    >>> zk.register_server('/databases/demo', addr1,
+    ...                    acl=zc.zk.OPEN_ACL_UNSAFE, weight=1, zone='east')
+    >>> zk.register_server('/databases/demo', addr2,
+    ...                    acl=zc.zk.OPEN_ACL_UNSAFE, weight=1, zone='west')
+
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, selection='weighted', zone='east',
+    ...     wait=False)
+    >>> def selected(client):
+    ...     return ['%s:%s' % addr for (_, addr) in client._rpc_mgr.addrlist]
+    >>> selected(client) == [addr1]
+    True
+    >>> zk.properties('/databases/demo/' + addr1).update(weight=0)
+    >>> selected(client) == [addr2]
+    True
+
+    >>> client.close()
+    >>> zk.close()
+    """
+
+def max_lag_drops_stale_servers():
+    """Clients can avoid servers that are behind.
+
+    Servers publish their last transactions when they publish metrics.
+    We'll register some servers by hand, one of which lags the other
+    by 2 minutes:
+
+    >>> import ZEO.tests.forker, ZODB.TimeStamp, binascii, time
+    >>> def tid(t):
+    ...     return binascii.hexlify(ZODB.TimeStamp.TimeStamp(
+    ...         *(time.gmtime(t)[:5] + (t % 60,))).raw())
+    >>> now = time.time()
+    >>> addr1, addr2 = sorted(['127.0.0.1:%s' % ZEO.tests.forker.get_port()
+    ...                        for i in range(2)])
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.register_server('/databases/demo', addr1,
+    ...                    acl=zc.zk.OPEN_ACL_UNSAFE,
+    ...                    last_transaction=tid(now))
+    >>> zk.register_server('/databases/demo', addr2,
+    ...                    acl=zc.zk.OPEN_ACL_UNSAFE,
+    ...                    last_transaction=tid(now-120))
+
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, max_lag=60, wait=False)
+    >>> def selected(client):
+    ...     return sorted('%s:%s' % addr
+    ...                   for (_, addr) in client._rpc_mgr.addrlist)
+    >>> selected(client) == [addr1]
+    True
+
+    When the lagging server catches up, it's used again:
+
+    >>> zk.properties('/databases/demo/' + addr2).update(
+    ...     last_transaction=tid(now-30))
+    >>> selected(client) == [addr1, addr2]
+    True
+
+    Servers that don't publish their last transactions are kept:
+
+    >>> zk.properties('/databases/demo/' + addr1).update(
+    ...     last_transaction=tid(now+120))
+    >>> selected(client) == [addr1]
+    True
+    >>> zk.properties('/databases/demo/' + addr2).set(pid=1)
+    >>> selected(client) == [addr1, addr2]
+    True
+
+    >>> client.close()
+
+    max_lag can be combined with selection policies:
+
+    >>> zk.properties('/databases/demo/' + addr1).set(
+    ...     last_transaction=tid(now), connections=1)
+    >>> zk.properties('/databases/demo/' + addr2).set(
+    ...     last_transaction=tid(now-120), connections=0)
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, max_lag=60, wait=False,
+    ...     selection='least-connections')
+    >>> selected(client) == [addr1]
+    True
+
+    >>> zk.properties('/databases/demo/' + addr2).update(
+    ...     last_transaction=tid(now))
+    >>> selected(client) == [addr2]
+    True
+
+    >>> client.close()
+    >>> zk.close()
+    """
+
+def debouncing_address_changes():
+    """Bursts of address changes can be handled at once.
+
+    >>> import ZEO.tests.forker
+    >>> addr1, addr2, addr3 = ['127.0.0.1:%s' % ZEO.tests.forker.get_port()
+    ...                        for i in range(3)]
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.register_server('/databases/demo', addr1)
+
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, debounce=.5, wait=False)
+    >>> def selected(client):
+    ...     return sorted('%s:%s' % addr
+    ...                   for (_, addr) in client._rpc_mgr.addrlist)
+    >>> selected(client) == [addr1]
+    True
+
+    If servers come and go, the client doesn't react until things have
+    been quiet for the debounce time:
+
+    >>> handler = zope.testing.loggingsupport.InstalledHandler('zc.zkzeo')
+    >>> zk.register_server('/databases/demo', addr2)
+    >>> zk.register_server('/databases/demo', addr3)
+    >>> _ = zk.delete('/databases/demo/' + addr2)
+    >>> selected(client) == [addr1]
+    True
+    >>> print handler
+    <BLANKLINE>
+
+    >>> time.sleep(1)
+    >>> selected(client) == sorted([addr1, addr3])
+    True
+    >>> len(handler.records)
+    1
+    >>> print handler.records[0].getMessage() # doctest: +ELLIPSIS
+    Addresses from <zookeeper.example.com:2181/databases/demo>: [...]
+    >>> handler.clear()
+
+    If the addresses end up the same, nothing's done at all:
+
+    >>> zk.register_server('/databases/demo', addr2)
+    >>> _ = zk.delete('/databases/demo/' + addr2)
+    >>> time.sleep(1)
+    >>> print handler
+    <BLANKLINE>
+
+    Pending changes are dropped when the client is closed:
+
+    >>> zk.register_server('/databases/demo', addr2)
+    >>> client.close()
+    >>> time.sleep(1)
+    >>> print handler
+    <BLANKLINE>
+
+    >>> handler.uninstall()
+    >>> zk.close()
+    """
+
+def staggered_failover():
+    """Clients can spread out failover when servers go away.
+
+    >>> import ZEO.tests.forker
+    >>> addr1, addr2 = ['127.0.0.1:%s' % ZEO.tests.forker.get_port()
+    ...                 for i in range(2)]
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.register_server('/databases/demo', addr1)
+    >>> zk.register_server('/databases/demo', addr2)
+
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, failover_jitter=1, wait=False)
+    >>> def selected(client):
+    ...     return sorted('%s:%s' % addr
+    ...                   for (_, addr) in client._rpc_mgr.addrlist)
+    >>> selected(client) == sorted([addr1, addr2])
+    True
+    >>> print client.zookeeper_failover_delay
+    None
+
+    When a server goes away, the client waits a random time, up to
+    failover_jitter seconds, before switching to the remaining servers.
+    The delay is available as zookeeper_failover_delay:
+
+    >>> with mock.patch('random.uniform') as uniform:
+    ...     uniform.return_value = .5
+    ...     _ = zk.delete('/databases/demo/' + addr1)
+    ...     uniform.call_args
+    call(0, 1)
+    >>> client.zookeeper_failover_delay
+    0.5
+    >>> selected(client) == sorted([addr1, addr2])
+    True
+    >>> time.sleep(1)
+    >>> selected(client) == [addr2]
+    True
+
+    Adding servers doesn't cause a delay:
+
+    >>> zk.register_server('/databases/demo', addr1)
+    >>> selected(client) == sorted([addr1, addr2])
+    True
+    >>> client.close()
+
+    You can also limit the number of clients in a process reconnecting
+    at once.  A client holds its place until it has reconnected, or
+    until a timeout:
+
+    >>> timeout = zc.zkzeo._client._reconnect_timeout
+    >>> zc.zkzeo._client._reconnect_timeout = 2
+    >>> client1, client2 = [
+    ...     zc.zkzeo.client(
+    ...         'zookeeper.example.com:2181', '/databases/demo',
+    ...         max_disconnect_poll=1, max_reconnects=1, wait=False)
+    ...     for i in range(2)]
+
+    >>> _ = zk.delete('/databases/demo/' + addr1)
+    >>> time.sleep(.5)
+    >>> sorted(map(selected, (client1, client2)), key=len) == [
+    ...     [addr2], sorted([addr1, addr2])]
+    True
+
+    No server's there, so the first client gives up its place after the
+    timeout and the second goes:
+
+    >>> time.sleep(3)
+    >>> map(selected, (client1, client2)) == [[addr2], [addr2]]
+    True
+
+    >>> client1.close()
+    >>> client2.close()
+    >>> zc.zkzeo._client._reconnect_timeout = timeout
+    >>> zc.zkzeo._client._reconnecting
+    [0]
+    >>> zk.close()
+    """
+
+def staggered_reconnect_after_a_crash():
+    """Clients spread out reconnecting when a server crashes, too.
+
+    A crashed server stays registered until its ZooKeeper session
+    expires, but ZEO reconnects as soon as it loses its connection.
+    With failover_jitter, the reconnect is held back for a random time.
+
+    >>> stop1 = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> stop2 = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> def address(stop):
+    ...     return '127.0.0.1:%s' % (
+    ...         stop.server.server.dispatcher.socket.getsockname()[1])
+    >>> stops = {address(stop1): stop1, address(stop2): stop2}
+
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, failover_jitter=5)
+    >>> connected = client.zookeeper_stats.server
+    >>> [other] = [addr for addr in stops if addr != connected]
+
+    We stop the server we're connected to without closing its
+    ZooKeeper session, so it stays registered:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> crashed = stops[connected].server
+    >>> with mock.patch('random.uniform') as uniform:
+    ...     uniform.return_value = 1
+    ...     with mock.patch.object(crashed, 'clear_socket'):
+    ...         _ = stops[connected]()
+    ...     wait(lambda : client.zookeeper_failover_delay == 1)
+    ...     uniform.call_args
+    call(0, 5)
+    >>> connected in zk.get_children('/databases/demo')
+    True
+    >>> [event['address'] for event in client.zookeeper_stats.events
+    ...  if event['name'] == 'failover'] == [connected]
+    True
+    >>> client.is_connected()
+    False
+
+    After the delay, ZEO reconnects to a server that's up:
+
+    >>> wait(lambda : client.zookeeper_stats.server == other)
+
+    >>> client.close()
+    >>> crashed.clear_socket()
+    >>> zk.close()
+    >>> _ = stops[other]()
+    """
+
+def failing_over_to_a_standby():
+    """Clients can keep a standby server checked for fast failover.
+
+    >>> stop1 = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> stop2 = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> def address(stop):
+    ...     return '127.0.0.1:%s' % (
+    ...         stop.server.server.dispatcher.socket.getsockname()[1])
+    >>> stops = {address(stop1): stop1, address(stop2): stop2}
+
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, standby=.1, failover_jitter=30)
+    >>> connected = client.zookeeper_stats.server
+    >>> [other] = [addr for addr in stops if addr != connected]
+
+    The server we aren't connected to is checked:
+
+    >>> standby = client.zookeeper_standby
+    >>> wait(lambda : standby.address == other)
+    >>> standby.last_transaction
+    u'0000000000000000'
+    >>> standby.usable()
+    True
+
+    A client whose cache hasn't seen a transaction can use any
+    standby that answers:
+
+    >>> with mock.patch.object(client._cache, 'getLastTid',
+    ...                        return_value=None):
+    ...     standby.usable()
+    True
+
+    When the server we're connected to is unregistered and shut down,
+    we fail over to the standby right away, rather than waiting up to
+    failover_jitter seconds:
+
+    >>> def promoted():
+    ...     return [event['address']
+    ...             for event in client.zookeeper_stats.events
+    ...             if event['name'] == 'promoted']
+    >>> def given():
+    ...     return sorted('%s:%s' % addr
+    ...                   for (_, addr) in client._rpc_mgr.addrlist)
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> _ = zk.delete('/databases/demo/' + connected)
+    >>> _ = stops[connected]()
+    >>> wait(lambda : client.zookeeper_stats.server == other, timeout=9)
+    >>> promoted() == [other]
+    True
+
+    There's no standby now, because there's only one server:
+
+    >>> wait(lambda : standby.address is None)
+    >>> standby.usable()
+    False
+
+    We also fail over to the standby when a server crashes, before
+    it's unregistered, instead of holding back ZEO's reconnect:
+
+    >>> stop3 = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> third = address(stop3)
+    >>> wait(lambda : standby.address == third and standby.usable())
+    >>> crashed = stops[other].server
+    >>> with mock.patch.object(crashed, 'clear_socket'):
+    ...     _ = stops[other]()
+    >>> wait(lambda : client.zookeeper_stats.server == third, timeout=9)
+    >>> promoted() == [other, third]
+    True
+    >>> [event for event in client.zookeeper_stats.events
+    ...  if event['name'] == 'failover']
+    []
+
+    Once it's connected to the standby, the client uses all of its
+    servers again:
+
+    >>> wait(lambda : given() == sorted([other, third]))
+    >>> _ = zk.delete('/databases/demo/' + other)
+    >>> crashed.clear_socket()
+
+    A standby that's behind the client's cache isn't usable.  Our
+    servers don't share data, so when we commit a transaction, a new
+    server is behind:
+
+    >>> import ZODB
+    >>> db = ZODB.DB(client)
+    >>> with db.transaction() as conn:
+    ...     conn.root.x = 1
+    >>> stop4 = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> wait(lambda : standby.address == address(stop4))
+    >>> standby.usable()
+    False
+
+    >>> db.close()
+    >>> zk.close()
+    >>> _ = stop3()
+    >>> _ = stop4()
+    """
+
+def unix_sockets_for_local_clients():
+    """Servers can publish Unix sockets for clients on the same host
+
+    >>> stop = zc.zkzeo.runzeo.test('''
+    ...   <zeo>
+    ...      address 127.0.0.1
+    ...   </zeo>
+    ...
+    ...   <zookeeper>
+    ...      connection zookeeper.example.com:2181
+    ...      path /databases/demo
+    ...      unix-socket zeo.sock
+    ...   </zookeeper>
+    ...   <mappingstorage>
+    ...   </mappingstorage>
+    ...   ''')
+    >>> sock = os.path.abspath('zeo.sock')
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> [addr] = zk.get_children('/databases/demo')
+    >>> properties = zk.get_properties('/databases/demo/' + addr)
+    >>> properties['unix_socket'] == sock
+    True
+    >>> properties['hostname'] == socket.gethostname()
+    True
+
+    Clients only use the socket if they're asked to:
+
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1)
+    >>> client._connection.addr == zc.zkzeo._client.parse_addr(addr)
+    True
+    >>> client.close()
+
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, unix_sockets=True)
+    >>> client._connection.addr == sock
+    True
+    >>> client.zookeeper_stats.addresses == [sock]
+    True
+
+    The statistics still report the registered address:
+
+    >>> client.zookeeper_stats.server == addr
+    True
+
+    >>> db = ZODB.DB(client)
+    >>> with db.transaction() as conn:
+    ...     conn.root.x = 1
+    >>> db.close()
+
+    Sockets of servers on other hosts aren't used:
+
+    >>> with mock.patch('socket.gethostname', return_value='elsewhere'):
+    ...     client = zc.zkzeo.client(
+    ...         'zookeeper.example.com:2181', '/databases/demo',
+    ...         max_disconnect_poll=1, unix_sockets=True)
+    >>> client._connection.addr == zc.zkzeo._client.parse_addr(addr)
+    True
+    >>> client.close()
+
+    In configurations, use the unix-sockets option:
+
+    >>> client = ZODB.config.storageFromString('''
+    ...     %import zc.zkzeo
+    ...     <zkzeoclient>
+    ...        zookeeper zookeeper.example.com:2181
+    ...        server /databases/demo
+    ...        max-disconnect-poll 1
+    ...        unix-sockets true
+    ...     </zkzeoclient>
+    ...     ''')
+    >>> client._connection.addr == sock
+    True
+    >>> client.close()
+
+    The socket is removed when the server stops:
+
+    >>> zk.close()
+    >>> stop().exception
+    >>> os.path.exists(sock)
+    False
+    """
+
+def opening_clients_without_blocking():
+    """Clients can be opened without blocking.
+
+    >>> import ZEO.tests.forker
+    >>> addr1, addr2 = ['127.0.0.1:%s' % ZEO.tests.forker.get_port()
+    ...                 for i in range(2)]
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+
+    There aren't any servers yet, so open_client returns right away and
+    the callback is called when a server registers:
+
+    >>> clients = []
+    >>> changes = []
+    >>> zc.zkzeo.open_client(
+    ...     'zookeeper.example.com:2181', '/databases/demo', clients.append,
+    ...     max_disconnect_poll=1, on_change=changes.append)
+    >>> clients
+    []
+
+    >>> zk.register_server('/databases/demo', addr1)
+    >>> wait(lambda : clients)
+    >>> [client] = clients
+    >>> ['%s:%s' % addr for (_, addr) in client._rpc_mgr.addrlist] == [addr1]
+    True
+
+    The on_change callback is called with the addresses when the client
+    is created and whenever they change:
+
+    >>> changes == [[addr1]]
+    True
+
+    The callback can close the storage:
+
+    >>> closed = []
+    >>> def close(addresses):
+    ...     if len(addresses) > 1:
+    ...         other.close()
+    ...         closed.append(addresses)
+    >>> other = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo', wait=False,
+    ...     max_disconnect_poll=1, on_change=close)
+
+    >>> zk.register_server('/databases/demo', addr2)
+    >>> map(sorted, changes[1:]) == [sorted([addr1, addr2])]
+    True
+    >>> len(closed)
+    1
+
+    >>> client.close()
+
+    If the storage can't be created, the errback is called:
+
+    >>> errors = []
+    >>> zc.zkzeo.open_client(
+    ...     'zookeeper.example.com:2181', '/databases/demo', clients.append,
+    ...     nonsense=1, errback=errors.append)
+    >>> wait(lambda : errors)
+    >>> errors
+    [TypeError("__init__() got an unexpected keyword argument 'nonsense'",)]
+    >>> len(clients)
+    1
+
+    >>> zk.close()
+    >>> zc.zkzeo._client._sessions
+    {}
+    """
+
+def opening_databases_in_parallel():
+    """zkzeoclient storages in a configuration can be opened at once.
+
+    >>> stop = zc.zkzeo.runzeo.test('''
+    ...   <zeo>
+    ...      address 127.0.0.1
+    ...   </zeo>
+    ...
+    ...   <zookeeper>
+    ...      connection zookeeper.example.com:2181
+    ...      path /databases/demo
+    ...   </zookeeper>
+    ...
+    ...   <filestorage>
+    ...      path demo.fs
+    ...   </filestorage>
+    ... ''')
+
+    >>> config = '''
+    ... %%import zc.zkzeo
+    ... %s
+    ... ''' % ''.join('''
+    ...   <zodb %s>
+    ...     <zkzeoclient>
+    ...       zookeeper zookeeper.example.com:2181
+    ...       server /databases/demo
+    ...       max-disconnect-poll 1
+    ...     </zkzeoclient>
+    ...   </zodb>
+    ... ''' % name for name in ('first', 'second', 'third'))
+
+    We'll make opening storages slow, and keep track of how many are
+    being opened at once:
+
+    >>> import ZODB.config, threading
+    >>> open = ZODB.config.ZEOClient.open
+    >>> opening = []
+    >>> most = []
+    >>> def slow_open(self):
+    ...     opening.append(threading.current_thread().getName())
+    ...     most.append(len(opening))
+    ...     time.sleep(1)
+    ...     opening.pop()
+    ...     return open(self)
+
+    >>> with mock.patch.object(ZODB.config.ZEOClient, 'open', slow_open):
+    ...     db = zc.zkzeo.databaseFromString(config)
+    >>> max(most)
+    3
+
+    You can limit the number of threads used:
+
+    >>> del most[:]
+    >>> with mock.patch.object(ZODB.config.ZEOClient, 'open', slow_open):
+    ...     db2 = zc.zkzeo.databaseFromString(config, threads=2)
+    >>> max(most)
+    2
+    >>> for d in db2.databases.values():
+    ...     d.close()
+
+    >>> sorted(db.databases)
+    ['first', 'second', 'third']
+    >>> [d.storage.is_connected() for d in db.databases.values()]
+    [True, True, True]
+    >>> for d in db.databases.values():
+    ...     d.close()
+
+    If any storages can't be opened, you get an error listing all of
+    the failures, and any storages that were opened are closed:
+
+    >>> config = config.replace(
+    ...    '''<zodb second>
+    ...     <zkzeoclient>
+    ...       zookeeper zookeeper.example.com:2181
+    ...       server /databases/demo''',
+    ...    '''<zodb second>
+    ...     <zkzeoclient second>
+    ...       zookeeper zookeeper.example.com:2181
+    ...       server /databases/nonexistent''').replace(
+    ...    '''<zodb third>
+    ...     <zkzeoclient>''',
+    ...    '''<zodb third>
+    ...     <zkzeoclient third>
+    ...       selection nonsense''')
+
+    >>> zc.zkzeo.databaseFromString(config)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    Traceback (most recent call last):
+    ...
+    OpenError: Couldn't open storages:
+    second (NoNodeException: /databases/nonexistent),
+    third (ValueError: Unknown selection, 'nonsense')
+
+    >>> zc.zkzeo._client._sessions
+    {}
+
+    >>> stop().exception
+    """
+
+def lazy_databases():
+    """Databases can be opened on first use
+
+    >>> stop = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> def connections():
+    ...     return sum(len(c) for c in
+    ...                stop.server.server.connections.values())
+
+    Passing lazy to DB sets up the ZooKeeper watch, but doesn't open
+    the client storage:
+
+    >>> db = zc.zkzeo.DB('zookeeper.example.com:2181', '/databases/demo',
+    ...                  max_disconnect_poll=1, lazy=True)
+    >>> [session] = zc.zkzeo._client._sessions.values()
+    >>> session.refs
+    {'/databases/demo': 1}
+    >>> db._db, connections()
+    (None, 0)
+
+    When the database is first used, it's opened:
+
+    >>> with db.transaction() as conn:
+    ...     conn.root.x = 1
+    >>> db.storage.is_connected(), connections()
+    (True, 1)
+    >>> session.refs
+    {'/databases/demo': 1}
+    >>> db.close()
+    >>> zc.zkzeo._client._sessions
+    {}
+
+    Lazy databases that are closed before they're used are never
+    opened:
+
+    >>> db = zc.zkzeo.DB('zookeeper.example.com:2181', '/databases/demo',
+    ...                  max_disconnect_poll=1, lazy=True)
+    >>> db.close()
+    >>> zc.zkzeo._client._sessions
+    {}
+    >>> db.open()
+    Traceback (most recent call last):
+    ...
+    ValueError: Database is closed
+
+    In configurations, use the lazy option.  Lazy databases stand in
+    for the databases in multi-databases until they're opened:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> _ = zk.create('/databases/other', '', zc.zk.OPEN_ACL_UNSAFE)
+    >>> zk.close()
+    >>> stop_other = zc.zkzeo.runzeo.test(
+    ...     '/databases/other', None, 'zookeeper.example.com:2181')
+
+    >>> db = zc.zkzeo.databaseFromString('''
+    ...   %import zc.zkzeo
+    ...   <zodb main>
+    ...     <zkzeoclient>
+    ...       zookeeper zookeeper.example.com:2181
+    ...       server /databases/demo
+    ...       max-disconnect-poll 1
+    ...     </zkzeoclient>
+    ...   </zodb>
+    ...   <zodb other>
+    ...     <zkzeoclient>
+    ...       zookeeper zookeeper.example.com:2181
+    ...       server /databases/other
+    ...       max-disconnect-poll 1
+    ...       lazy true
+    ...     </zkzeoclient>
+    ...   </zodb>
+    ...   ''')
+    >>> sorted(db.databases)
+    ['main', 'other']
+    >>> other = db.databases['other']
+    >>> other.__class__.__name__, other._db
+    ('LazyDB', None)
+    >>> [session] = zc.zkzeo._client._sessions.values()
+    >>> sorted(session.refs.items())
+    [('/databases/demo', 1), ('/databases/other', 1)]
+
+    >>> conn = db.open()
+    >>> conn.get_connection('other').root()
+    {}
+    >>> db.databases['other'] is other._db
+    True
+    >>> db.databases['other'].database_name
+    'other'
+    >>> conn.close()
+
+    >>> for d in db.databases.values():
+    ...     d.close()
+    >>> zc.zkzeo._client._sessions
+    {}
+
+    Only the zc.zkzeo functions support the option.  ZODB.DB reads the
+    root object when it's created, so the ZODB functions open storages
+    right away, and a warning says the option is ignored:
+
+    >>> import ZODB.config
+    >>> handler = zope.testing.loggingsupport.InstalledHandler('zc.zkzeo')
+    >>> db = ZODB.config.databaseFromString('''
+    ...   %import zc.zkzeo
+    ...   <zodb other>
+    ...     <zkzeoclient>
+    ...       zookeeper zookeeper.example.com:2181
+    ...       server /databases/other
+    ...       max-disconnect-poll 1
+    ...       lazy true
+    ...     </zkzeoclient>
+    ...   </zodb>
+    ...   ''')
+    >>> print [record for record in handler.records
+    ...        if record.levelname == 'WARNING'][0].getMessage()
+    ... # doctest: +NORMALIZE_WHITESPACE
+    The zkzeoclient storage for <zookeeper.example.com:2181/databases/other>
+    is lazy, but it's being opened right away.  Lazy storages are only
+    supported by zc.zkzeo.databaseFromString and databaseFromFile.
+    >>> handler.uninstall()
+    >>> db.close()
+
+    >>> stop().exception
+    >>> stop_other().exception
+    """
+
+def client_stats():
+    """Client storages keep statistics in a zookeeper_stats attribute
+
+    >>> import ZEO.tests.forker
+    >>> addr = '127.0.0.1:%s' % ZEO.tests.forker.get_port()
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> stop = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> [server] = zk.get_children('/databases/demo')
+
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1)
+    >>> stats = client.zookeeper_stats
+    >>> from pprint import pprint
+    >>> pprint(stats.as_dict()) # doctest: +ELLIPSIS
+    {'addresses': ['127.0.0.1:...'],
+     'changes': 1,
+     'notifications': 1,
+     'server': '127.0.0.1:...',
+     'switchover_seconds': ...,
+     'switchovers': 1,
+     'wait_seconds': ...}
+    >>> stats.server == server
+    True
+    >>> [event['name'] for event in stats.events]
+    ['waited', 'changed', 'switched']
+
+    Hooks are called with events:
+
+    >>> events = []
+    >>> stats.hooks.append(events.append)
+    >>> zk.register_server('/databases/demo', addr)
+    >>> [sorted(event) for event in events]
+    [['addresses', 'name', 'time'], ['addresses', 'name', 'seconds', 'time']]
+    >>> [event['name'] for event in events]
+    ['changed', 'switched']
+    >>> sorted(events[0]['addresses']) == sorted([server, addr])
+    True
+    >>> stats.notifications, stats.changes, stats.switchovers
+    (2, 2, 2)
+
+    An activity monitor reports address changes along with ZODB
+    activity:
+
+    >>> import ZODB
+    >>> db = ZODB.DB(client)
+    >>> db.setActivityMonitor(zc.zkzeo._client.ActivityMonitor())
+    >>> with db.transaction() as conn:
+    ...     conn.root.x = 1
+    >>> [div] = db.getActivityMonitor().getActivityAnalysis(
+    ...     start=time.time()-60, divisions=1)
+    >>> pprint(div) # doctest: +ELLIPSIS
+    {'connections': 1,
+     'end': ...,
+     'loads': ...,
+     'start': ...,
+     'stores': 1,
+     'zookeeper_changes': 2,
+     'zookeeper_switchovers': 2}
+
+    >>> db.close()
+    >>> zk.close()
+    >>> _ = stop()
+    """
+
+def address_cache():
+    """Clients can start with cached addresses, without waiting for ZooKeeper
+
+    >>> stop = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> [addr] = zk.get_children('/databases/demo')
+
+    Addresses are saved when they change.  They're saved in a
+    separate thread, so ZooKeeper's thread isn't held up:
+
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, address_cache='addresses.json')
+    >>> import json
+    >>> def cached():
+    ...     try:
+    ...         with open('addresses.json') as f:
+    ...             return json.load(f)
+    ...     except IOError:
+    ...         pass
+    >>> wait(lambda : cached() == {
+    ...     'zookeeper.example.com:2181/databases/demo': [addr]})
+    >>> client.close()
+
+    Now, we'll make ZooKeeper slow:
+
+    >>> import threading
+    >>> zookeeper_ready = threading.Event()
+    >>> acquire = zc.zkzeo._client._acquire
+    >>> def slow_acquire(*args):
+    ...     zookeeper_ready.wait()
+    ...     return acquire(*args)
+    >>> patcher = mock.patch('zc.zkzeo._client._acquire',
+    ...                      side_effect=slow_acquire)
+    >>> _ = patcher.start()
+
+    The client starts right away with the cached addresses, and
+    connects:
+
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, address_cache='addresses.json')
+    >>> wait(client.is_connected)
+    >>> hasattr(client, 'zookeeper_addresses')
+    False
+
+    So does a client defined in a configuration:
+
+    >>> client2 = ZODB.config.storageFromString('''
+    ...     %import zc.zkzeo
+    ...     <zkzeoclient>
+    ...        zookeeper zookeeper.example.com:2181
+    ...        server /databases/demo
+    ...        max-disconnect-poll 1
+    ...        address-cache addresses.json
+    ...     </zkzeoclient>
+    ...     ''')
+    >>> wait(client2.is_connected)
+
+    When ZooKeeper answers, the clients use the addresses in ZooKeeper:
+
+    >>> zookeeper_ready.set()
+    >>> wait(lambda : hasattr(client, 'zookeeper_addresses'))
+    >>> wait(lambda : hasattr(client2, 'zookeeper_addresses'))
+    >>> patcher.stop()
+
+    >>> zk.register_server('/databases/demo', 'example.com:8100')
+    >>> sorted('%s:%s' % a for (_, a) in client._rpc_mgr.addrlist) == sorted(
+    ...     [addr, 'example.com:8100'])
+    True
+    >>> wait(lambda : cached() == {
+    ...     'zookeeper.example.com:2181/databases/demo':
+    ...     sorted([addr, 'example.com:8100'])})
+
+    >>> _ = zk.delete('/databases/demo/example.com:8100')
+    >>> wait(lambda : cached() == {
+    ...     'zookeeper.example.com:2181/databases/demo': [addr]})
+
+    Changes made while saving are saved together:
+
+    >>> save = zc.zkzeo._client._save_addresses
+    >>> started, saving = threading.Event(), threading.Event()
+    >>> saved = []
+    >>> def slow_save(cache, changes):
+    ...     started.set()
+    ...     saving.wait(5)
+    ...     saved.append(sorted(changes))
+    ...     return save(cache, changes)
+    >>> def cache_addresses(path):
+    ...     zc.zkzeo._client._cache_addresses(
+    ...         'addresses.json', 'zookeeper.example.com:2181', path, [addr])
+    >>> with mock.patch('zc.zkzeo._client._save_addresses',
+    ...                 side_effect=slow_save):
+    ...     cache_addresses('/a')
+    ...     wait(started.is_set)
+    ...     cache_addresses('/b')
+    ...     cache_addresses('/c')
+    ...     saving.set()
+    ...     wait(lambda : not zc.zkzeo._client._cache_saving)
+    >>> saved # doctest: +NORMALIZE_WHITESPACE
+    [['zookeeper.example.com:2181/a'],
+     ['zookeeper.example.com:2181/b', 'zookeeper.example.com:2181/c']]
+    >>> sorted(cached())
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [u'zookeeper.example.com:2181/a', u'zookeeper.example.com:2181/b',
+     u'zookeeper.example.com:2181/c',
+     u'zookeeper.example.com:2181/databases/demo']
+
+    >>> client.close()
+    >>> client2.close()
+    >>> zc.zkzeo._client._sessions
+    {}
+
+    If a client is closed before ZooKeeper answers, it doesn't use
+    ZooKeeper:
+
+    >>> zookeeper_ready.clear()
+    >>> _ = patcher.start()
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, address_cache='addresses.json')
+    >>> client.close()
+    >>> zookeeper_ready.set()
+    >>> time.sleep(.1)
+    >>> patcher.stop()
+    >>> zc.zkzeo._client._sessions
+    {}
+
+    Cached addresses may be stale.  A client that waits to connect
+    waits for the addresses in ZooKeeper, rather than for servers
+    that are gone:
+
+    >>> with open('addresses.json', 'w') as f:
+    ...     json.dump({'zookeeper.example.com:2181/databases/demo':
+    ...                ['127.0.0.1:1']}, f)
+    >>> client = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, address_cache='addresses.json')
+    >>> client.is_connected()
+    True
+    >>> client.zookeeper_stats.server == addr
+    True
+    >>> wait(lambda : cached() == {
+    ...     'zookeeper.example.com:2181/databases/demo': [addr]})
+    >>> client.close()
+
+    The same goes for clients defined in configurations:
+
+    >>> with open('addresses.json', 'w') as f:
+    ...     json.dump({'zookeeper.example.com:2181/databases/demo':
+    ...                ['127.0.0.1:1']}, f)
+    >>> client = ZODB.config.storageFromString('''
+    ...     %import zc.zkzeo
+    ...     <zkzeoclient>
+    ...        zookeeper zookeeper.example.com:2181
+    ...        server /databases/demo
+    ...        max-disconnect-poll 1
+    ...        address-cache addresses.json
+    ...     </zkzeoclient>
+    ...     ''')
+    >>> client.is_connected()
+    True
+    >>> client.close()
+    >>> zc.zkzeo._client._sessions
+    {}
+
+    >>> zk.close()
+    >>> _ = stop()
+    """
+
+def prewarming_caches_from_snapshots():
+    """New clients can start with a snapshot of another client's cache
+
+    >>> stop = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+
+    >>> import persistent.mapping, transaction, ZODB
+    >>> peer = ZODB.DB(zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, client='peer'))
+    >>> with peer.transaction() as conn:
+    ...     for i in range(10):
+    ...         conn.root()[i] = persistent.mapping.PersistentMapping(x=i)
+
+    The peer saves a snapshot of its cache:
+
+    >>> zc.zkzeo.snapshot_cache(peer.storage, 'snapshot.zec')
+    11
+
+    A transaction is committed after the snapshot:
+
+    >>> with peer.transaction() as conn:
+    ...     conn.root()[0]['x'] = 42
+    ...     oid0 = conn.root()[0]._p_oid
+
+    A new client starts with the snapshot:
+
+    >>> worker = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, client='worker',
+    ...     cache_snapshot='snapshot.zec')
+    >>> os.path.exists('worker-1.zec')
+    True
+    >>> [event['snapshot'] for event in worker.zookeeper_stats.events
+    ...  if event['name'] == 'prewarmed']
+    ['snapshot.zec']
+
+    Objects changed since the snapshot was made were invalidated when
+    the client connected, but the rest are in its cache:
+
+    >>> len(list(worker._cache.contents()))
+    10
+    >>> worker._cache.load(oid0)
+    >>> db = ZODB.DB(worker)
+    >>> with db.transaction() as conn:
+    ...     [conn.root()[i]['x'] for i in range(3)]
+    [42, 1, 2]
+    >>> db.close()
+
+    The snapshot is only used if the client's cache doesn't exist:
+
+    >>> worker = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, client='worker',
+    ...     cache_snapshot='snapshot.zec')
+    >>> [event for event in worker.zookeeper_stats.events
+    ...  if event['name'] == 'prewarmed']
+    []
+    >>> worker.close()
+
+    It can also be given in configurations:
+
+    >>> worker = ZODB.config.storageFromString('''
+    ...     %import zc.zkzeo
+    ...     <zkzeoclient>
+    ...        zookeeper zookeeper.example.com:2181
+    ...        server /databases/demo
+    ...        max-disconnect-poll 1
+    ...        client worker2
+    ...        cache-snapshot snapshot.zec
+    ...     </zkzeoclient>
+    ...     ''')
+    >>> len(list(worker._cache.contents()))
+    10
+    >>> worker.close()
+
+    Files that aren't snapshots are ignored:
+
+    >>> with open('snapshot.zec', 'w') as f:
+    ...     f.write('nonsense')
+    >>> handler = zope.testing.loggingsupport.InstalledHandler('zc.zkzeo')
+    >>> worker = zc.zkzeo.client(
+    ...     'zookeeper.example.com:2181', '/databases/demo',
+    ...     max_disconnect_poll=1, client='worker3',
+    ...     cache_snapshot='snapshot.zec')
     >>> print handler # doctest: +NORMALIZE_WHITESPACE
     zc.zkzeo WARNING
-      OK: Got addresses from <zookeeper.example.com:2181/databases/demo>
-    zc.zkzeo WARNING
-      OK: Got addresses from <zookeeper.example.com:2181/databases/demo>
-    zc.zkzeo INFO
-      Addresses from <zookeeper.example.com:2181/databases/demo>:
-      ['127.0.0.1:52814']
+      snapshot.zec isn't a ZEO cache file
     zc.zkzeo INFO
       Addresses from <zookeeper.example.com:2181/databases/demo>:
       ['127.0.0.1:52814']
-
     >>> handler.uninstall()
+    >>> len(list(worker._cache.contents()))
+    0
+    >>> worker.close()
 
-    >>> t1.value.close()
-    >>> t2.value.close()
+    >>> peer.close()
     >>> _ = stop()
     """
 
-def client_start_with_empty_addresses_and_no_wait():
+def server_publishes_metrics():
+    """Servers can publish load metrics.
+
+    >>> stop = zc.zkzeo.runzeo.test('''
+    ...   <zeo>
+    ...      address 127.0.0.1
+    ...   </zeo>
+    ...
+    ...   <zookeeper>
+    ...      connection zookeeper.example.com:2181
+    ...      path /databases/demo
+    ...      metrics-interval 1
+    ...   </zookeeper>
+    ...
+    ...   <filestorage>
+    ...      path demo.fs
+    ...   </filestorage>
+    ... ''')
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> [addr] = zk.get_children('/databases/demo')
+    >>> registration = zk.get_properties('/databases/demo/' + addr)
+    >>> path = registration['metrics']
+    >>> path == '/zkzeo-metrics/%s-%s' % (socket.gethostname(), os.getpid())
+    True
+    >>> for item in sorted(zk.get_properties(path).items()):
+    ...     print '%s = %r' % item
+    active_txns = 0
+    commit_rate = 0.0
+    connections = 0
+    last_transaction = u'0000000000000000'
+    size = 4
+    waiting = 0
+
+    The metrics are published on a separate node, because it has to be
+    writable.  The registration is read-only, so other ZooKeeper clients
+    can't change it:
+
+    >>> zk.get_acl('/databases/demo/' + addr)[1] == zc.zk.READ_ACL_UNSAFE
+    True
+    >>> zk.set('/databases/demo/' + addr, '{}')
+    Traceback (most recent call last):
+    ...
+    NoAuthException: not authenticated
+
+    Metrics are updated as the server is used:
+
+    >>> properties = zk.properties(path)
+
+    >>> db = zc.zkzeo.DB('zookeeper.example.com:2181', '/databases/demo')
+    >>> wait(lambda : properties['connections'] == 1)
+    >>> with db.transaction() as conn:
+    ...     conn.root.x = 1
+    >>> wait(lambda : properties['last_transaction'] ==
+    ...      db.lastTransaction().encode('hex'))
+    >>> properties['size'] > 4
+    True
+
+    Once we stop committing, the commit rate goes back to 0:
+
+    >>> wait(lambda : properties['commit_rate'] == 0.0)
+
+    Metrics are only published when they change:
+
+    >>> with mock.patch('zc.zk.ZooKeeper.set') as set:
+    ...     time.sleep(2.5)
+    ...     set.call_count
+    0
+
+    >>> db.close()
+    >>> zk.close()
+    >>> _ = stop()
+
+    The metrics thread stops when the server does:
+
+    >>> import threading
+    >>> [t for t in threading.enumerate()
+    ...  if t.name == 'zookeeper_metrics_thread']
+    []
     """
-    >>> handler = zope.testing.loggingsupport.InstalledHandler('zc.zkzeo')
 
-    >>> c1 = zc.zkzeo.client(
+def server_tracks_hot_objects():
+    """Servers can track their most frequently loaded objects
+
+    >>> stop = zc.zkzeo.runzeo.test('''
+    ...   <zeo>
+    ...      address 127.0.0.1
+    ...   </zeo>
+    ...
+    ...   <zookeeper>
+    ...      connection zookeeper.example.com:2181
+    ...      path /databases/demo
+    ...      monitor-server 127.0.0.1
+    ...      hot-objects 3
+    ...   </zookeeper>
+    ...
+    ...   <filestorage>
+    ...      path demo.fs
+    ...   </filestorage>
+    ... ''')
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> [addr] = zk.get_children('/databases/demo')
+    >>> properties = zk.properties('/databases/demo/' + addr)
+    >>> properties['hot_objects']
+    u'hot_objects'
+
+    >>> import persistent.mapping
+    >>> db = zc.zkzeo.DB('zookeeper.example.com:2181', '/databases/demo')
+    >>> with db.transaction() as conn:
+    ...     for i in range(5):
+    ...         conn.root()[i] = persistent.mapping.PersistentMapping()
+    >>> with db.transaction() as conn:
+    ...     oids = [conn.root()[i]._p_oid for i in range(5)]
+
+    We'll load some objects more than others, bypassing the client
+    cache:
+
+    >>> server = db.storage._server
+    >>> for i in range(1200):
+    ...     _ = server.loadEx(oids[i % 2])
+    >>> for i in range(1200):
+    ...     _ = server.loadEx(oids[2 + i % 3])
+    >>> _ = server.loadEx(oids[4])
+
+    >>> import json, socket
+    >>> def hot_objects(*args):
+    ...     host, port = properties['monitor'].split(':')
+    ...     sock = socket.create_connection((host, int(port)))
+    ...     sock.sendall(' '.join(('hot_objects', ) + args) + '\\n')
+    ...     f = sock.makefile()
+    ...     result = json.loads(f.readline())
+    ...     f.close()
+    ...     sock.close()
+    ...     return result
+
+    >>> hot = hot_objects()['1']
+    >>> [oid.decode('hex') for (oid, count) in hot['objects']] == [
+    ...     oids[0], oids[1], oids[4]]
+    True
+    >>> [count for (oid, count) in hot['objects']]
+    [600, 600, 401]
+
+    Only 3 objects are tracked, so counts are approximate.  They may
+    be overstated by up to the error:
+
+    >>> hot['error']
+    400
+
+    >>> hot = hot_objects('1')['1']
+    >>> [oid.decode('hex') for (oid, count) in hot['objects']] == [oids[0]]
+    True
+
+    >>> db.close()
+    >>> zk.close()
+    >>> _ = stop()
+    >>> zc.monitor.last_listener.close()
+    >>> del zc.zk.monitor._servers[:]
+
+    The thread that summarizes loads stops when the server does:
+
+    >>> import threading
+    >>> [t for t in threading.enumerate()
+    ...  if t.name == 'zookeeper_hot_objects_thread']
+    []
+    """
+
+def draining_servers():
+    """Servers can be drained before they shut down
+
+    >>> stop1 = zc.zkzeo.runzeo.test('''
+    ...   <zeo>
+    ...      address 127.0.0.1
+    ...   </zeo>
+    ...
+    ...   <zookeeper>
+    ...      connection zookeeper.example.com:2181
+    ...      path /databases/demo
+    ...      monitor-server 127.0.0.1
+    ...      drain-grace 30
+    ...   </zookeeper>
+    ...
+    ...   <mappingstorage>
+    ...   </mappingstorage>
+    ... ''')
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> [addr1] = zk.get_children('/databases/demo')
+    >>> monitor = zk.properties('/databases/demo/' + addr1)['monitor']
+
+    >>> client = zc.zkzeo.client(
     ...     'zookeeper.example.com:2181', '/databases/demo',
-    ...     max_disconnect_poll=1, wait=False)
+    ...     max_disconnect_poll=1)
+    >>> stop2 = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> [addr2] = [addr for addr in zk.get_children('/databases/demo')
+    ...            if addr != addr1]
+    >>> client.zookeeper_stats.server == addr1
+    True
 
-    >>> c2 = ZODB.config.storageFromString('''
+    We're in the middle of a transaction:
+
+    >>> import transaction
+    >>> txn = transaction.Transaction()
+    >>> client.tpc_begin(txn)
+
+    Now, we'll drain the first server, using the drain monitor command:
+
+    >>> import socket
+    >>> host, port = monitor.split(':')
+    >>> sock = socket.create_connection((host, int(port)))
+    >>> sock.sendall('drain\\n')
+    >>> f = sock.makefile()
+    >>> f.readline()
+    'Draining\\n'
+    >>> f.close()
+    >>> sock.close()
+
+    The server unregisters:
+
+    >>> zk.get_children('/databases/demo') == [addr2]
+    True
+
+    The client waits for its transaction to finish before moving:
+
+    >>> time.sleep(.5)
+    >>> client.zookeeper_stats.server == addr1
+    True
+
+    >>> client.tpc_abort(txn)
+    >>> wait(lambda : [event['address']
+    ...                for event in client.zookeeper_stats.events
+    ...                if event['name'] == 'migrated'] == [addr1])
+
+    New transactions wait until the client has reconnected:
+
+    >>> client.tpc_begin(txn)
+    >>> client.zookeeper_stats.server == addr2
+    True
+    >>> client.tpc_abort(txn)
+
+    Once its clients are gone, the server shuts down, without waiting
+    for the grace period:
+
+    >>> wait(lambda : stop1.server.server._StorageServer__closed, timeout=9)
+    >>> _ = stop1()
+
+    >>> client.close()
+    >>> zk.close()
+    >>> _ = stop2()
+    >>> zc.monitor.last_listener.close()
+    >>> del zc.zk.monitor._servers[:]
+    """
+
+def hot_objects_are_bounded():
+    """
+    >>> hot_objects = zc.zkzeo.runzeo.HotObjects(2, buffer_size=4)
+    >>> for oid in 'aaabcccdccccdddd':
+    ...     hot_objects.record(oid)
+
+    Recording loads just fills buffers.  They're summarized when
+    they're folded:
+
+    >>> len(hot_objects.full), hot_objects.counts
+    (4, {})
+    >>> hot_objects.top()
+    ([('c', 7), ('d', 5)], 3)
+    >>> hot_objects.fold()
+    >>> len(hot_objects.full), len(hot_objects.counts)
+    (0, 2)
+    >>> hot_objects.top()
+    ([('c', 7), ('d', 5)], 3)
+
+    Loads not folded into the summary yet are included:
+
+    >>> for oid in 'bbb':
+    ...     hot_objects.record(oid)
+    >>> hot_objects.top()
+    ([('c', 7), ('b', 6)], 5)
+    >>> hot_objects.top(1)
+    ([('c', 7)], 5)
+    """
+
+def resolving_host_names():
+    """Clients can resolve registered host names ahead of time
+
+    Register a server by name:
+
+    >>> stop = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> [addr] = zk.get_children('/databases/demo')
+    >>> port = zc.zkzeo._client.parse_addr(addr)[1]
+
+    >>> zk.create('/databases/named', '', zc.zk.OPEN_ACL_UNSAFE)
+    '/databases/named'
+    >>> zk.register_server('/databases/named', ('localhost', port))
+
+    With the resolve_ttl option, ZEO is given IP addresses:
+
+    >>> getaddrinfo = socket.getaddrinfo
+    >>> def lookups(lookup):
+    ...     return [args for (args, kw) in lookup.call_args_list
+    ...             if args[0] == 'localhost']
+
+    >>> with mock.patch('socket.getaddrinfo',
+    ...                 side_effect=getaddrinfo) as lookup:
+    ...     client = zc.zkzeo.client(
+    ...         'zookeeper.example.com:2181', '/databases/named',
+    ...         max_disconnect_poll=1, resolve_ttl=60)
+    >>> len(lookups(lookup))
+    1
+    >>> client._connection.addr == ('127.0.0.1', port)
+    True
+    >>> client.zookeeper_stats.addresses
+    ['127.0.0.1:PORT']
+
+    The statistics still report the registered address:
+
+    >>> client.zookeeper_stats.server
+    'localhost:PORT'
+
+    Names are resolved when registrations change, not when ZEO
+    reconnects, and the results are shared by the clients in the
+    process until they expire:
+
+    >>> with mock.patch('socket.getaddrinfo',
+    ...                 side_effect=getaddrinfo) as lookup:
+    ...     client2 = zc.zkzeo.client(
+    ...         'zookeeper.example.com:2181', '/databases/named',
+    ...         max_disconnect_poll=1, resolve_ttl=60)
+    ...     client2.close()
+    >>> lookups(lookup)
+    []
+
+    When registrations change, names are resolved in the background,
+    so a slow DNS server doesn't hold up ZooKeeper.  Until a name is
+    resolved, it's left for ZEO to resolve:
+
+    >>> import threading
+    >>> dns = threading.Event()
+    >>> def slow_getaddrinfo(host, *args):
+    ...     if host == 'zeo.example.com':
+    ...         dns.wait(9)
+    ...         return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+    ...                  ('127.0.0.2', 0))]
+    ...     return getaddrinfo(host, *args)
+    >>> patcher = mock.patch('socket.getaddrinfo',
+    ...                      side_effect=slow_getaddrinfo)
+    >>> _ = patcher.start()
+    >>> zk.register_server('/databases/named', ('zeo.example.com', port))
+    >>> sorted(addr.split(':')[0]
+    ...        for addr in client.zookeeper_stats.addresses)
+    ['127.0.0.1', 'zeo.example.com']
+
+    Once it's resolved, ZEO gets the new address:
+
+    >>> dns.set()
+    >>> wait(lambda : sorted(client.zookeeper_stats.addresses) == [
+    ...     '127.0.0.1:%s' % port, '127.0.0.2:%s' % port])
+    >>> patcher.stop()
+
+    If a name can't be resolved, the last address it resolved to is
+    used:
+
+    >>> with mock.patch('time.time', return_value=time.time() + 61):
+    ...     with mock.patch('socket.getaddrinfo',
+    ...                     side_effect=socket.gaierror(-2, 'failed')):
+    ...         zc.zkzeo._client._resolve('localhost', 60)
+    '127.0.0.1'
+
+    Otherwise, the name is left for ZEO to resolve:
+
+    >>> with mock.patch('socket.getaddrinfo',
+    ...                 side_effect=socket.gaierror(-2, 'failed')):
+    ...     zc.zkzeo._client._resolve('db.example.com', 60)
+    'db.example.com'
+
+    Numeric addresses aren't looked up:
+
+    >>> with mock.patch('socket.getaddrinfo') as lookup:
+    ...     zc.zkzeo._client._resolve('10.0.0.1', 60)
+    ...     zc.zkzeo._client._resolve('::1', 60)
+    '10.0.0.1'
+    '::1'
+    >>> lookup.call_count
+    0
+
+    In configurations, use the resolve-ttl option:
+
+    >>> client2 = ZODB.config.storageFromString('''
     ...     %import zc.zkzeo
     ...     <zkzeoclient>
     ...        zookeeper zookeeper.example.com:2181
-    ...        server /databases/demo
+    ...        server /databases/named
     ...        max-disconnect-poll 1
-    ...        wait false
+    ...        resolve-ttl 1m
     ...     </zkzeoclient>
     ...     ''')
+    >>> client2._connection.addr == ('127.0.0.1', port)
+    True
+    >>> client2.close()
 
-    Wait a while:
-
-    >>> time.sleep(9)
+    >>> client.close()
+    >>> zk.close()
+    >>> _ = stop()
+    """
 
-    At this point, since there aren't any addresses, so both clients are
-    disconnected:
+def ipv6_addresses():
+    """IPv6 addresses are registered and parsed in brackets
 
-    >>> c1.is_connected(), c2.is_connected()
-    (False, False)
+    >>> zc.zkzeo._client.parse_addr('[::1]:8100')
+    ('::1', 8100)
+    >>> zc.zkzeo._client.parse_addr('127.0.0.1:8100')
+    ('127.0.0.1', 8100)
+    >>> zc.zkzeo._client.format_addr(('::1', 8100))
+    '[::1]:8100'
+    >>> zc.zkzeo._client.format_addr(('127.0.0.1', 8100))
+    '127.0.0.1:8100'
 
-    >>> print handler
-    zc.zkzeo WARNING
-      No addresses from <zookeeper.example.com:2181/databases/demo>
-    zc.zkzeo WARNING
-      No addresses from <zookeeper.example.com:2181/databases/demo>
+    A server listening on all interfaces registers its global IPv6
+    addresses, as well as its IPv4 addresses, if it can listen on
+    both:
 
-    >>> handler.clear()
+    >>> import ZEO.zrpc.server
+    >>> ZEO.zrpc.server._has_dualstack
+    True
 
-    Now let's start a server:
+    >>> ifaddresses = lambda i: {2: [dict(addr='1.2.3.4')],
+    ...                          10: [dict(addr='2001:db8::1'),
+    ...                               dict(addr='fe80::1%iface'),
+    ...                               dict(addr='::1')]}
+    >>> with mock.patch('netifaces.ifaddresses', ifaddresses):
+    ...     stop = zc.zkzeo.runzeo.test('''
+    ...         <zeo>
+    ...             address :
+    ...         </zeo>
+    ...
+    ...         <zookeeper>
+    ...            connection zookeeper.example.com:2181
+    ...            path /databases/demo
+    ...         </zookeeper>
+    ...
+    ...         <mappingstorage>
+    ...         </mappingstorage>
+    ...         ''')
 
-    >>> stop = zc.zkzeo.runzeo.test(
-    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.print_tree('/databases/demo')
+    /demo
+      /1.2.3.4:PORT
+        hostname = u'zeo1.example.com'
+        pid = PID
+      /[2001:db8::1]:PORT
+        hostname = u'zeo1.example.com'
+        pid = PID
+
+    Clients leave out addresses their ZEO can't connect to.  ZEO 4
+    only connects to IPv4 addresses:
+
+    >>> zc.zkzeo._client._ipv6_supported()
+    False
+    >>> addresses = zk.get_children('/databases/demo')
+    >>> zc.zkzeo._client._usable(sorted(addresses)) == [
+    ...     a for a in addresses if a.startswith('1.2.3.4:')]
+    True
 
-    And the clients will connect:
+    >>> with mock.patch('zc.zkzeo._client._ipv6_supported',
+    ...                 return_value=True):
+    ...     len(zc.zkzeo._client._usable(addresses))
+    2
 
-    >>> wait(c1.is_connected)
-    >>> wait(c2.is_connected)
+    >>> zk.close()
+    >>> _ = stop()
+    """
 
-    >>> print handler # doctest: +NORMALIZE_WHITESPACE
-    zc.zkzeo WARNING
-      OK: Addresses from <zookeeper.example.com:2181/databases/demo>
-    zc.zkzeo INFO
-      Addresses from <zookeeper.example.com:2181/databases/demo>:
-      ['127.0.0.1:52814']
-    zc.zkzeo WARNING
-      OK: Addresses from <zookeeper.example.com:2181/databases/demo>
-    zc.zkzeo INFO
-      Addresses from <zookeeper.example.com:2181/databases/demo>:
-      ['127.0.0.1:52814']
+def waiting_with_only_ipv6_addresses():
+    """Clients keep waiting, without spinning, while the only registered
+    addresses are ones ZEO can't connect to:
 
-    >>> handler.uninstall()
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.register_server('/databases/demo', '[2001:db8::1]:8100')
+
+    >>> when_addresses = zc.zkzeo._client._when_addresses
+    >>> with mock.patch('zc.zkzeo._client._when_addresses',
+    ...                 side_effect=when_addresses) as when:
+    ...     client = zc.zkzeo.client(
+    ...         'zookeeper.example.com:2181', '/databases/demo',
+    ...         wait_timeout=1)
+    >>> when.call_count
+    1
+    >>> client.is_connected()
+    False
+    >>> client.close()
+
+    Clients opened without blocking aren't created until there are
+    addresses they can use:
+
+    >>> opened = []
+    >>> zc.zkzeo.open_client(
+    ...     'zookeeper.example.com:2181', '/databases/demo', opened.append,
+    ...     max_disconnect_poll=1)
+    >>> opened
+    []
+
+    >>> zk.register_server('/databases/demo', '127.0.0.1:1')
+    >>> wait(lambda : opened)
+    >>> [client] = opened
+    >>> client.zookeeper_stats.addresses
+    ['127.0.0.1:PORT']
+    >>> client.close()
 
-    >>> c1.close()
-    >>> c2.close()
-    >>> _ = stop()
+    >>> zk.close()
     """
 
 def using_empty_hosts():
@@ -279,6 +2558,7 @@ def using_empty_hosts():
     >>> zk.print_tree('/databases/demo')
     /demo
       /1.2.3.4:57718
+        hostname = u'zeo1.example.com'
         pid = 8315
 
     >>> zk.close()
@@ -351,6 +2631,42 @@ def nagios_edge():
      waiting=0
     1
 
+    A server listening on all interfaces also registers its IPv6
+    addresses, with the same properties.  They're recognized as
+    belonging to the same server:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> [addr] = zk.get_children('/databases/demo')
+    >>> port = zc.zkzeo.status.parse_address(addr)[1]
+    >>> zc.zkzeo.status.parse_address('[2001:db8::1]:%s' % port) == (
+    ...     '2001:db8::1', port)
+    True
+    >>> _ = zk.create('/databases/demo/[2001:db8::1]:%s' % port,
+    ...               zk.get('/databases/demo/' + addr)[0],
+    ...               zc.zk.READ_ACL_UNSAFE, zookeeper.EPHEMERAL)
+
+    >>> monitor('''
+    ... zookeeper.example.com:2181 /databases/demo
+    ... '''.strip().split())
+    Empty storage u'1'
+    1
+    >>> monitor('''
+    ... zookeeper.example.com:2181 -M./sock /databases/demo
+    ... '''.strip().split())
+    Empty storage u'1'
+    1
+
+    A registration from another server is still ambiguous:
+
+    >>> _ = zk.create('/databases/demo/127.0.0.2:%s' % port, '{}',
+    ...               zc.zk.READ_ACL_UNSAFE, zookeeper.EPHEMERAL)
+    >>> monitor('''
+    ... zookeeper.example.com:2181 /databases/demo
+    ... '''.strip().split())
+    Couldn't find server in ZooKeeper
+    2
+    >>> zk.close()
+
     >>> zc.zk.monitor._servers.append(
     ...     dict(path='/databases/demo', address='foo.com:1'))
     >>> monitor('''
@@ -377,6 +2693,226 @@ def nagios_edge():
     >>> zc.monitor.last_listener.close()
     """
 
+def nagios_batch():
+    """zkzeo-nagios can check many paths at once
+
+    >>> import pkg_resources
+    >>> monitor = pkg_resources.load_entry_point(
+    ...     'zc.zkzeo', 'console_scripts', 'zkzeo-nagios')
+
+    >>> stop = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> zk.create('/databases/other', '', zc.zk.OPEN_ACL_UNSAFE)
+    '/databases/other'
+
+    Paths can be given as arguments or in a file.  A line of JSON is
+    output for each path, and the highest status is returned.  A single
+    ZooKeeper session is used:
+
+    >>> with open('paths', 'w') as f:
+    ...     f.write('# Paths to check\\n/databases/other\\n\\n/nonexistent\\n')
+
+    >>> with mock.patch('zc.zk.ZK', side_effect=zc.zk.ZK) as ZK:
+    ...     monitor(['-b', '-j2', 'zookeeper.example.com:2181',
+    ...              '/databases/demo', '-f', 'paths'])
+    ...     ZK.call_count # doctest: +ELLIPSIS
+    {"address": "127.0.0.1:...", "output": "Empty storage u'1'", "path": "/databases/demo", "status": 1}
+    {"address": null, "output": "Couldn't find server in ZooKeeper", "path": "/databases/other", "status": 2}
+    {"address": null, "output": "NoNodeException: ...", "path": "/nonexistent", "status": 2}
+    2
+    1
+
+    In batch mode, the status path is a directory with a status file
+    for each path:
+
+    >>> monitor(['-b', '-m', '-sstatus', 'zookeeper.example.com:2181',
+    ...          '/databases/demo']) # doctest: +ELLIPSIS
+    {"address": "127.0.0.1:...", "output": "Empty storage u'1'|active_txns=0\\n| connections=0\\n waiting=0", "path": "/databases/demo", "status": 1}
+    1
+    >>> import os
+    >>> os.listdir('status')
+    ['%2Fdatabases%2Fdemo']
+
+    A ZooKeeper connection string is required:
+
+    >>> import StringIO
+    >>> with mock.patch('sys.stderr', StringIO.StringIO()) as stderr:
+    ...     monitor(['-b'])
+    Traceback (most recent call last):
+    ...
+    SystemExit: 2
+    >>> print stderr.getvalue().strip().split('\\n')[-1].split(': ', 1)[1]
+    error: A ZooKeeper connection string is required
+
+    >>> zk.close()
+    >>> _ = stop()
+    """
+
+def benchmarks():
+    """The benchmark script records results as JSON
+
+    >>> import json, zc.zkzeo.benchmark
+    >>> zc.zkzeo.benchmark.main(
+    ...     ['-n2', '-c2', '-d.1', '-o', 'results.json'])
+    >>> with open('results.json') as f:
+    ...     results = json.load(f)
+    >>> sorted(results)
+    [u'benchmarks', u'options', u'platform', u'python', u'time', u'version']
+    >>> for name, result in sorted(results['benchmarks'].items()):
+    ...     print name, sorted(result)
+    concurrent_open [u'clients', u'seconds', u'total_seconds', u'wall_seconds']
+    failover [u'seconds', u'total_seconds']
+    first_address [u'registered', u'registering', u'total_seconds']
+    idle_cpu [u'baseline_cpu_percent', u'clients', u'cpu_percent', u'total_seconds']
+    >>> sorted(results['benchmarks']['failover']['seconds'])
+    [u'count', u'max', u'mean', u'median', u'min', u'p90']
+    >>> results['benchmarks']['concurrent_open']['seconds']['count']
+    4
+
+    The benchmarks don't leave clients or servers behind:
+
+    >>> zc.zkzeo._client._sessions
+    {}
+
+    Results can be compared with earlier results.  Medians that got
+    worse by more than the tolerance are regressions:
+
+    >>> old = dict(benchmarks=dict(
+    ...     failover=dict(seconds=dict(median=.1), total_seconds=2),
+    ...     first_address=dict(registered=dict(median=.002))))
+    >>> new = dict(benchmarks=dict(
+    ...     failover=dict(seconds=dict(median=.3), total_seconds=3),
+    ...     first_address=dict(registered=dict(median=.001))))
+    >>> lines, regressed = zc.zkzeo.benchmark.compare(old, new, 1.5)
+    >>> print '\\n'.join(lines)
+    failover.seconds: 0.100000 -> 0.300000 (3.00x) REGRESSION
+    first_address.registered: 0.002000 -> 0.001000 (0.50x)
+    >>> regressed
+    True
+
+    When comparing, the script exits with a status of 1 if there are
+    regressions:
+
+    >>> with open('old.json', 'w') as f:
+    ...     json.dump(old, f)
+    >>> with mock.patch('zc.zkzeo.benchmark.run', return_value=new):
+    ...     with mock.patch('sys.stderr', sys.stdout):
+    ...         zc.zkzeo.benchmark.main(['-o', 'new.json', '-C', 'old.json'])
+    failover.seconds: 0.100000 -> 0.300000 (3.00x) REGRESSION
+    first_address.registered: 0.002000 -> 0.001000 (0.50x)
+    1
+    >>> with mock.patch('zc.zkzeo.benchmark.run', return_value=new):
+    ...     with mock.patch('sys.stderr', sys.stdout):
+    ...         zc.zkzeo.benchmark.main(['-o', 'new.json', '-C', 'old.json',
+    ...                                  '-t', '4'])
+    failover.seconds: 0.100000 -> 0.300000 (3.00x)
+    first_address.registered: 0.002000 -> 0.001000 (0.50x)
+    """
+
+def exporter():
+    """The exporter serves metrics for servers registered under a path
+
+    >>> stop = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+
+    >>> import zc.zkzeo.exporter
+    >>> exporter = zc.zkzeo.exporter.Exporter(
+    ...     'zookeeper.example.com:2181', '/databases', interval=.1)
+    >>> exporter.discover()
+    >>> exporter.poll()
+
+    >>> def show(*names):
+    ...     for line in exporter.text.split('\\n'):
+    ...         if line.split('{')[0] in names:
+    ...             print line
+    >>> show('zkzeo_servers', 'zkzeo_up', 'zkzeo_connections',
+    ...      'zkzeo_commits_total', 'zkzeo_last_transaction_timestamp_seconds')
+    zkzeo_servers{path="/databases/demo"} 1
+    zkzeo_up{path="/databases/demo",server="127.0.0.1:PORT"} 1
+    zkzeo_connections{path="/databases/demo",server="127.0.0.1:PORT",storage="1"} 0
+    zkzeo_commits_total{path="/databases/demo",server="127.0.0.1:PORT",storage="1"} 0
+
+    A server's IPv6 registrations don't count as additional servers:
+
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> [addr] = zk.get_children('/databases/demo')
+    >>> _ = zk.create('/databases/demo/[::1]:%s' % addr.split(':')[1],
+    ...               zk.get('/databases/demo/' + addr)[0],
+    ...               zc.zk.READ_ACL_UNSAFE, zookeeper.EPHEMERAL)
+    >>> exporter.poll()
+    >>> show('zkzeo_servers', 'zkzeo_up')
+    zkzeo_servers{path="/databases/demo"} 1
+    zkzeo_up{path="/databases/demo",server="127.0.0.1:PORT"} 1
+    >>> zk.close()
+
+    >>> db = zc.zkzeo.DB('zookeeper.example.com:2181', '/databases/demo')
+    >>> with db.transaction() as conn:
+    ...     conn.root.x = 1
+    >>> exporter.poll()
+    >>> show('zkzeo_connections', 'zkzeo_commits_total',
+    ...      'zkzeo_last_transaction_timestamp_seconds')
+    ... # doctest: +ELLIPSIS
+    zkzeo_connections{path="/databases/demo",server="127.0.0.1:PORT",storage="1"} 1
+    zkzeo_commits_total{path="/databases/demo",server="127.0.0.1:PORT",storage="1"} 2
+    zkzeo_last_transaction_timestamp_seconds{...} 1...
+    >>> db.close()
+
+    The metrics are served over HTTP:
+
+    >>> import urllib2
+    >>> server = exporter.serve(('127.0.0.1', 0))
+    >>> thread = zc.thread.Thread(server.handle_request)
+    >>> response = urllib2.urlopen(
+    ...     'http://127.0.0.1:%s/metrics' % server.server_address[1])
+    >>> response.info()['Content-Type']
+    'text/plain; version=0.0.4'
+    >>> response.read() == exporter.text
+    True
+    >>> thread.join(9)
+    >>> server.server_close()
+
+    Registration changes are counted:
+
+    >>> _ = stop()
+    >>> exporter.poll()
+    >>> show('zkzeo_servers', 'zkzeo_registrations_total',
+    ...      'zkzeo_unregistrations_total', 'zkzeo_up')
+    zkzeo_servers{path="/databases/demo"} 0
+    zkzeo_registrations_total{path="/databases/demo"} 0
+    zkzeo_unregistrations_total{path="/databases/demo"} 1
+
+    The tree under the path is watched, and only searched for servers
+    again when it changes, not when servers come and go:
+
+    >>> exporter.stale.is_set()
+    False
+    >>> zk = zc.zk.ZooKeeper('zookeeper.example.com:2181')
+    >>> _ = zk.create('/databases/other', '', zc.zk.OPEN_ACL_UNSAFE)
+    >>> wait(exporter.stale.is_set)
+
+    Normally, the exporter polls in a thread:
+
+    >>> stop = zc.zkzeo.runzeo.test(
+    ...     '/databases/demo', None, 'zookeeper.example.com:2181')
+    >>> stop_other = zc.zkzeo.runzeo.test(
+    ...     '/databases/other', None, 'zookeeper.example.com:2181')
+    >>> thread = exporter.start()
+    >>> wait(lambda : 'zkzeo_up{path="/databases/other"' in exporter.text)
+    >>> wait(lambda : 'zkzeo_up{path="/databases/demo"' in exporter.text)
+    >>> show('zkzeo_registrations_total')
+    zkzeo_registrations_total{path="/databases/demo"} 1
+    zkzeo_registrations_total{path="/databases/other"} 0
+    >>> exporter.stale.is_set()
+    False
+
+    >>> exporter.stop()
+    >>> thread.join(9)
+    >>> zk.close()
+    >>> _ = stop()
+    >>> _ = stop_other()
+    """
+
 def setUp(test):
     setupstack.setUpDirectory(test)
     zc.zk.testing.setUp(test, tree='/databases\n  /demo\n')
@@ -408,14 +2944,20 @@ def setUp(test):
     del zc.zk.monitor._servers[:]
 
 def tearDown(test):
+    zc.zkzeo._client._sessions.clear()
+    zc.zkzeo._client._resolved.clear()
+    zope.component.getGlobalSiteManager().unregisterHandler(
+        zc.zk.monitor.notify, (zc.zk.RegisteringServer, ))
     zc.zk.testing.tearDown(test)
     setupstack.tearDown(test)
 
 def test_suite():
     checker = zope.testing.renormalizing.RENormalizing([
         (re.compile(r'pid = \d+'), 'pid = PID'),
+        (re.compile(r"hostname = u'[^']*'"), 'hostname = HOSTNAME'),
         (re.compile(r'127.0.0.1:\d+'), '127.0.0.1:PORT'),
         (re.compile(r'1.2.3.4:\d+'), '1.2.3.4:PORT'),
+        (re.compile(r'\]:\d+'), ']:PORT'),
         (re.compile(r'localhost:\d+'), 'localhost:PORT'),
         (re.compile(r"':\d+'"), "':PORT'"),
         ])